@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import random
+from main import get_touched_video_ids, get_untouched_videos
+
+COMMENTS_PREFIX = 'comments/UCxxxxxxxxxxxxxxxxxxxxxx'
+# リストでの差分はO(V・(C+I))のため、この件数までのみ計測する
+LIST_MAX_COUNT = 10000
+
+
+def list_diff(videos, comments_blob_names, ignore_videos):
+    untouched_videos = []
+    for video in videos:
+        video_id = video['video_id']
+        if f'{COMMENTS_PREFIX}/{video_id}.json' not in [x for x in comments_blob_names] and \
+                not [x for x in comments_blob_names if x.startswith(f'{COMMENTS_PREFIX}/{video_id}.parts/')]:
+            if video_id in [x['video_id'] for x in ignore_videos]:
+                continue
+            untouched_videos.append(video)
+
+    return untouched_videos
+
+
+def set_diff(videos, comments_blob_names, ignore_videos):
+    touched_video_ids = get_touched_video_ids(
+        comments_blob_names, COMMENTS_PREFIX)
+    ignore_video_ids = set(x['video_id'] for x in ignore_videos)
+
+    return get_untouched_videos(videos, touched_video_ids, ignore_video_ids)
+
+
+def benchmark(count):
+    videos = [{'video_id': f'{i:011d}'} for i in range(count)]
+    # 8割は取得済み、1割は取得途中、5%は無視リストに登録済みとする
+    shuffled = random.sample(videos, count)
+    touched = shuffled[:count * 8 // 10]
+    in_progress = shuffled[count * 8 // 10:count * 9 // 10]
+    comments_blob_names = [f'{COMMENTS_PREFIX}/{x["video_id"]}.json' for x in touched] + \
+        [f'{COMMENTS_PREFIX}/{x["video_id"]}.parts/00001.json' for x in in_progress]
+    ignore_videos = [{'video_id': x['video_id']}
+                     for x in shuffled[count * 9 // 10:count * 95 // 100]]
+
+    if count <= LIST_MAX_COUNT:
+        start = time.perf_counter()
+        untouched = list_diff(videos, comments_blob_names, ignore_videos)
+        elapsed = time.perf_counter() - start
+        print(f'{count}: list diff {elapsed * 1000:.2f} ms, untouched: {len(untouched)}')
+
+    start = time.perf_counter()
+    untouched = set_diff(videos, comments_blob_names, ignore_videos)
+    elapsed = time.perf_counter() - start
+    print(f'{count}: set diff {elapsed * 1000:.2f} ms, untouched: {len(untouched)}')
+
+
+if __name__ == '__main__':
+    counts = [int(x) for x in sys.argv[1:]] or [1000, 10000, 50000]
+    for count in counts:
+        benchmark(count)
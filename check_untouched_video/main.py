@@ -4,9 +4,15 @@ import os
 import sys
 import re
 import json
+import time
 import yaml
+from pathlib import Path
 from google.oauth2.service_account import Credentials
-from google.cloud import storage, pubsub_v1
+from gcp_io import get_json, get_blob_names, publish_messages, print_round_trips
+
+# 送信に失敗したメッセージのみを、この回数まで送信し直す
+PUBLISH_MAX_ATTEMPTS = 3
+PUBLISH_RETRY_SECONDS = 1
 
 
 def main(event, context):
@@ -16,6 +22,10 @@ def main(event, context):
     topic_name = os.environ.get('PUBSUB_TOPIC_NAME')
     videos_prefix = os.environ.get('GCS_VIDEOS_PREFIX').rstrip('/')
     comments_prefix = os.environ.get('GCS_COMMENTS_PREFIX').rstrip('/')
+    ignore_videos_prefix = os.environ.get(
+        'GCS_IGNORE_VIDEOS_PREFIX', 'ignore_videos').rstrip('/')
+    # コメントをParquetで保存している場合は、Parquetの保存先も取得済みとする
+    parquet_prefix = os.environ.get('GCS_PARQUET_PREFIX', '').rstrip('/')
 
     credentials = None
     if gcp_credentials_path and os.path.exists(gcp_credentials_path):
@@ -38,76 +48,93 @@ def main(event, context):
         raise Exception(
             f'cannnot recognize channel_id from path: {finalized_blob_path}')
 
-    ignore_videos = get_json(
-        bucket_name, 'ignore_videos.json', credentials=credentials)
-    ignore_videos = ignore_videos if ignore_videos else []
-
     videos = get_json(bucket_name, finalized_blob_path,
                       credentials=credentials)
     comments_prefix = f'{comments_prefix}/{channel_id}'
-    comments_blobs = list(get_blob_list(
-        bucket_name, comments_prefix, credentials=credentials))
+    touched_video_ids = get_touched_video_ids(get_blob_names(
+        bucket_name, comments_prefix, credentials=credentials), comments_prefix)
+    if parquet_prefix:
+        parquet_prefix = f'{parquet_prefix}/{channel_id}'
+        touched_video_ids |= get_touched_video_ids(get_blob_names(
+            bucket_name, parquet_prefix, credentials=credentials), parquet_prefix)
 
     if not videos:
         print(f'missing videos of {channel_id}')
         return
 
     print(f'total videos: {len(videos)}')
-    print(f'already checked videos: {len(comments_blobs)}')
+    print(f'already checked videos: {len(touched_video_ids)}')
+    # 無視リストはチャンネルごとのファイル名のみを取得する
+    ignore_video_ids = get_ignore_video_ids(get_blob_names(
+        bucket_name, f'{ignore_videos_prefix}/{channel_id}', credentials=credentials))
+    print(f'ignore videos: {len(ignore_video_ids)}')
+    untouched_videos = get_untouched_videos(
+        videos, touched_video_ids, ignore_video_ids)
+    print(f'untouched videos: {len(untouched_videos)}')
+
+    messages = []
+    for video in untouched_videos:
+        video_id = video['video_id']
+        print(f'publish message of {video_id}')
+        messages.append(json.dumps({
+            'channel_id': channel_id,
+            'video_id': video_id
+        }, ensure_ascii=False))
+
+    # 1件ずつ結果を待たず、まとめて送信する
+    # 関数全体を再実行すると送信済みのメッセージも重複して送信されるため、例外にはしない
+    # 送信できなかった動画は未取得のままのため、次に動画一覧が更新されたときに再度送信される
+    published_count = 0
+    for attempt in range(PUBLISH_MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(PUBLISH_RETRY_SECONDS * 2 ** (attempt - 1))
+            print(f'retry to publish {len(messages)} messages')
+        results = publish_messages(
+            topic_name, project_id, messages, credentials=credentials)
+        messages = []
+        for message, result, error in results:
+            if error:
+                print(f'Pub/Sub error: {message}, {type(error).__name__}: {error}')
+                messages.append(message)
+            else:
+                print(f'Pub/Sub result: {message}, {result}')
+                published_count += 1
+        if not messages:
+            break
+
+    print(f'published messages: {published_count}, failed: {len(messages)}')
+    for message in messages:
+        print(f'failed to publish: {message}')
+
+
+def get_touched_video_ids(blob_names, comments_prefix):
+    # 取得途中のパートがある場合も、取得済みとする
+    video_ids = set()
+    for blob_name in blob_names:
+        file_name = blob_name[len(comments_prefix) + 1:].split('/')[0]
+        for suffix in ('.json', '.parquet', '.parts'):
+            if file_name.endswith(suffix):
+                video_ids.add(file_name[:-len(suffix)])
+                break
+
+    return video_ids
+
+
+def get_ignore_video_ids(blob_names):
+    return set(Path(x).stem for x in blob_names if x.endswith('.json'))
+
+
+def get_untouched_videos(videos, touched_video_ids, ignore_video_ids):
+    untouched_videos = []
     for video in videos:
         video_id = video['video_id']
-        print(f'check video_id: {video_id}')
-
-        if f'{comments_prefix}/{video_id}.json' not in [x.name for x in comments_blobs]:
-            if video_id in [x['video_id'] for x in ignore_videos]:
-                print(f'ignore video: {video_id}')
-                continue
-
-            print(f'publish message of {video_id}')
-            message = json.dumps({
-                'channel_id': channel_id,
-                'video_id': video_id
-            }, ensure_ascii=False)
-            result = publish_message(
-                topic_name, project_id, message, credentials=credentials)
-            print(f'{video_id} Pub/Sub result: {result}')
-
-
-def get_blob_list(bucket_name, prefix, delimiter=None, credentials=None):
-    project_id = None
-    if credentials:
-        project_id = credentials.project_id
-    storage_client = storage.Client(
-        project=project_id, credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
-    blob_list = bucket.list_blobs(prefix=f'{prefix}/', delimiter=delimiter)
-    return blob_list
-
-
-def get_json(bucket_name, blob_path, credentials=None):
-    project_id = None
-    if credentials:
-        project_id = credentials.project_id
-    storage_client = storage.Client(
-        project=project_id, credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
-    # ファイルがない場合は、Noneを返す
-    data = None
-    blob = bucket.get_blob(blob_path)
-    if blob:
-        data = json.loads(blob.download_as_string())
-
-    return data
-
-
-def publish_message(topic_name, project_id, message, attributes={}, credentials=None):
-    publisher = pubsub_v1.PublisherClient(credentials=credentials)
-
-    topic_path = publisher.topic_path(project_id, topic_name)
-    future = publisher.publish(topic_path, str(
-        message).encode('utf-8'), **attributes)
+        if video_id in touched_video_ids:
+            continue
+        if video_id in ignore_video_ids:
+            continue
+        untouched_videos.append(video)
 
-    return future.result()
+    return untouched_videos
 
 
 if __name__ == '__main__':
@@ -120,3 +147,4 @@ if __name__ == '__main__':
     event = {'name': sys.argv[1]}
 
     main(event, None)
+    print_round_trips()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from google.oauth2.service_account import Credentials
+from gcp_io import get_json, create_json, print_round_trips
+
+MIGRATE_CONCURRENCY = 16
+
+
+# ignore_videos.jsonを、動画ごとのファイルに分割する
+def migrate_ignore_videos(source_path='ignore_videos.json'):
+    bucket_name = os.environ.get('GCS_BUCKET_NAME')
+    gcp_credentials_path = os.environ.get('GCP_CREDENTIALS_PATH')
+    ignore_videos_prefix = os.environ.get(
+        'GCS_IGNORE_VIDEOS_PREFIX', 'ignore_videos').rstrip('/')
+
+    credentials = None
+    if gcp_credentials_path and os.path.exists(gcp_credentials_path):
+        credentials = Credentials.from_service_account_file(
+            gcp_credentials_path)
+        print(f'load credential file {gcp_credentials_path}')
+
+    ignore_videos = get_json(bucket_name, source_path, credentials=credentials)
+    if not ignore_videos:
+        print(f'not found: {source_path}')
+        return
+    print(f'ignore videos: {len(ignore_videos)}')
+
+    def create_ignore_video(data):
+        blob_path = f'{ignore_videos_prefix}/{data["channel_id"]}/{data["video_id"]}.json'
+        return create_json(bucket_name, blob_path, data, credentials=credentials)
+
+    # 登録済みのファイルは上書きしない
+    with ThreadPoolExecutor(max_workers=MIGRATE_CONCURRENCY) as executor:
+        created = list(executor.map(create_ignore_video, ignore_videos))
+    print(f'created: {sum(created)}, already exists: {len(created) - sum(created)}')
+
+
+if __name__ == '__main__':
+    with open('.env.yaml', 'r') as f:
+        env = yaml.safe_load(f)
+        for k, v in env.items():
+            if not isinstance(v, (list, dict)):
+                os.environ[k] = str(v)
+
+    source_path = sys.argv[1] if len(sys.argv) >= 2 else 'ignore_videos.json'
+
+    migrate_ignore_videos(source_path)
+    print_round_trips()
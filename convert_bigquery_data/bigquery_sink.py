@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from google.api_core import exceptions
+from gcp_io import json_serial, count_round_trip
+
+# 変換したコメントをBigQueryへ書き込む
+# load: コメントの日付ごとのパーティションにまとめてロードジョブを作る
+# stream: コメントIDをinsertIdにしてストリーミング挿入する
+# いずれも重複はありうるため(at-least-once)、コメントIDで重複を除いて参照する
+# テーブルはtimestamp列の日単位で分割しておく
+SINK_MODES = ('load', 'stream')
+DEFAULT_BATCH_ROWS = 100000
+STREAM_BATCH_ROWS = 500
+# 同じ行のロードが失敗していた場合に、ジョブIDを変えて再実行する回数
+MAX_LOAD_ATTEMPTS = 10
+
+sink_lock = threading.Lock()
+bigquery_sink = None
+
+
+def get_bigquery_sink():
+    # BIGQUERY_TABLEが未指定の場合は、Noneを返す
+    global bigquery_sink
+    table_id = os.environ.get('BIGQUERY_TABLE')
+    if not table_id:
+        return None
+    with sink_lock:
+        if bigquery_sink is None:
+            if os.environ.get('GCP_IO_BACKEND') == 'fake':
+                client = FakeBigQueryClient(
+                    Path(os.environ.get('GCP_IO_FAKE_DIR', 'fake_gcs')) / '_bigquery')
+                load_job_config = None
+                location = os.environ.get('BIGQUERY_LOCATION') or None
+            else:
+                client = create_bigquery_client(table_id)
+                load_job_config = create_load_job_config()
+                location = os.environ.get('BIGQUERY_LOCATION') or get_dataset_location(
+                    client, table_id)
+            bigquery_sink = BigQuerySink(
+                client, table_id, mode=os.environ.get('BIGQUERY_SINK_MODE', 'load'),
+                batch_rows=int(os.environ.get(
+                    'BIGQUERY_BATCH_ROWS', DEFAULT_BATCH_ROWS)),
+                load_job_config=load_job_config, location=location)
+
+    return bigquery_sink
+
+
+def create_bigquery_client(table_id):
+    from google.cloud import bigquery
+    from google.oauth2.service_account import Credentials
+    credentials = None
+    gcp_credentials_path = os.environ.get('GCP_CREDENTIALS_PATH')
+    if gcp_credentials_path and os.path.exists(gcp_credentials_path):
+        credentials = Credentials.from_service_account_file(
+            gcp_credentials_path)
+
+    return bigquery.Client(project=table_id.split('.')[0], credentials=credentials)
+
+
+def get_dataset_location(client, table_id):
+    # US、EU以外のリージョンのジョブは、ロケーションを指定しないと取得できない
+    dataset_id = '.'.join(table_id.split('.')[:2])
+
+    return client.get_dataset(dataset_id).location
+
+
+def create_load_job_config():
+    from google.cloud import bigquery
+    return bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+
+
+def to_row(comment):
+    # timestamp(秒)をBigQueryのTIMESTAMPとして読める文字列にする
+    row = dict(comment)
+    row['timestamp'] = datetime.fromtimestamp(
+        comment['timestamp'], tz=timezone.utc).isoformat()
+
+    return json.loads(json.dumps(row, ensure_ascii=False, default=json_serial))
+
+
+def get_partition(comment):
+    return datetime.fromtimestamp(comment['timestamp'], tz=timezone.utc).strftime('%Y%m%d')
+
+
+def get_job_id(table_id, partition, rows):
+    # 同じ行のロードを再実行した場合に、同じジョブIDになるようにする
+    digest = hashlib.sha1()
+    for comment_id in sorted(x['id'] for x in rows):
+        digest.update(comment_id.encode('utf-8'))
+        digest.update(b'\n')
+    table_name = table_id.split('.')[-1]
+
+    return f'convert_{table_name}_{partition}_{digest.hexdigest()}'
+
+
+class BigQuerySink(object):
+    def __init__(self, client, table_id, mode='load', batch_rows=DEFAULT_BATCH_ROWS, load_job_config=None, location=None):
+        if mode not in SINK_MODES:
+            raise ValueError(f'unknown sink mode: {mode}')
+        self.client = client
+        self.table_id = table_id
+        self.mode = mode
+        self.batch_rows = batch_rows
+        self.load_job_config = load_job_config
+        self.location = location
+        # Trueの場合は、呼び出し側がflush()するまで複数動画分をまとめる
+        self.deferred = False
+        self.lock = threading.Lock()
+        self.partitions = {}
+        self.row_count = 0
+
+    def tee(self, comments):
+        # アップロードするコメントを流しながら、書き込み用に保持する
+        for comment in comments:
+            yield comment
+            self.add(comment)
+
+    def add(self, comment):
+        with self.lock:
+            self.partitions.setdefault(
+                get_partition(comment), []).append(to_row(comment))
+            self.row_count += 1
+            full = self.row_count >= self.batch_rows
+        if full:
+            self.flush()
+
+    def clear(self):
+        with self.lock:
+            self.partitions = {}
+            self.row_count = 0
+
+    def flush(self):
+        with self.lock:
+            partitions = self.partitions
+            self.partitions = {}
+            self.row_count = 0
+        if not partitions:
+            return
+
+        if self.mode == 'stream':
+            for rows in partitions.values():
+                self.insert_rows(rows)
+            return
+
+        # パーティションごとにジョブを作り、すべて完了するまで待つ
+        jobs = []
+        for partition, rows in sorted(partitions.items()):
+            job = self.load_rows(partition, rows)
+            if job:
+                jobs.append((partition, rows, job))
+        for partition, rows, job in jobs:
+            job.result()
+            print(
+                f'bigquery load complete: {self.table_id}${partition}, rows: {len(rows)}, job: {job.job_id}')
+
+    def load_rows(self, partition, rows):
+        base_job_id = get_job_id(self.table_id, partition, rows)
+        for attempt in range(MAX_LOAD_ATTEMPTS):
+            job_id = f'{base_job_id}_{attempt}' if attempt else base_job_id
+            try:
+                return self.client.load_table_from_json(
+                    rows, f'{self.table_id}${partition}', job_config=self.load_job_config,
+                    job_id=job_id, location=self.location)
+            except exceptions.Conflict:
+                pass
+
+            # 同じ行のジョブが作成済みの場合は、エラーなく完了したときのみ再度ロードしない
+            job = self.client.get_job(job_id, location=self.location)
+            if job.state != 'DONE':
+                print(f'bigquery load is running: {job_id}')
+                return job
+            if job.error_result is None:
+                print(f'bigquery load already exists: {job_id}')
+                return None
+            print(f'bigquery load failed before: {job_id}, {job.error_result}')
+
+        raise Exception(
+            f'bigquery load failed {MAX_LOAD_ATTEMPTS} times: {base_job_id}')
+
+    def insert_rows(self, rows):
+        for i in range(0, len(rows), STREAM_BATCH_ROWS):
+            batch = rows[i:i + STREAM_BATCH_ROWS]
+            errors = self.client.insert_rows_json(
+                self.table_id, batch, row_ids=[x['id'] for x in batch])
+            if errors:
+                raise Exception(f'bigquery insert failed: {errors[:3]}')
+        print(f'bigquery insert complete: {self.table_id}, rows: {len(rows)}')
+
+
+class FakeBigQueryClient(object):
+    # 行をテーブル・パーティションごとのNDJSONに追記する
+    def __init__(self, root_dir):
+        self.root_dir = Path(root_dir)
+        self.lock = threading.Lock()
+
+    def load_table_from_json(self, rows, destination, job_config=None, job_id=None, location=None):
+        count_round_trip('bigquery_load')
+        table_id, partition = destination.split('$')
+        job_path = self.root_dir / 'jobs' / job_id
+        with self.lock:
+            if job_path.exists():
+                raise exceptions.Conflict(job_id)
+            job_path.parent.mkdir(parents=True, exist_ok=True)
+            job_path.write_text(json.dumps(
+                {'destination': destination, 'error_result': None}))
+            self.append_rows(self.root_dir / table_id / f'{partition}.ndjson', rows)
+
+        return FakeJob(job_id)
+
+    def get_job(self, job_id, location=None):
+        # ジョブのファイルのerror_resultを書き換えると、失敗したジョブとして扱う
+        count_round_trip('bigquery_get_job')
+        job_path = self.root_dir / 'jobs' / job_id
+        if not job_path.exists():
+            raise exceptions.NotFound(job_id)
+        job = json.loads(job_path.read_text())
+
+        return FakeJob(job_id, error_result=job.get('error_result'))
+
+    def insert_rows_json(self, table_id, rows, row_ids=None):
+        count_round_trip('bigquery_insert')
+        with self.lock:
+            self.append_rows(self.root_dir / table_id / 'streaming.ndjson', rows)
+
+        return []
+
+    def append_rows(self, path, rows):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False))
+                f.write('\n')
+
+
+class FakeJob(object):
+    def __init__(self, job_id, error_result=None):
+        self.job_id = job_id
+        self.state = 'DONE'
+        self.error_result = error_result
+
+    def result(self):
+        return self
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import json
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from concurrent.futures import Future
+from requests.adapters import HTTPAdapter
+from google.api_core import exceptions
+from google.cloud import storage, pubsub_v1
+
+# Cloud Storage / Pub/Subのクライアントを関数の実行間で使い回す
+# GCP_IO_BACKEND=fakeの場合は、GCP_IO_FAKE_DIRのローカルファイルを使用する
+HTTP_POOL_SIZE = 32
+LIST_PAGE_SIZE = 1000
+# 複数メッセージをまとめて送信する
+PUBLISH_BATCH_SETTINGS = pubsub_v1.types.BatchSettings(
+    max_messages=100, max_bytes=1024 * 1024, max_latency=0.05)
+
+clients_lock = threading.Lock()
+storage_client = None
+publisher_client = None
+buckets = {}
+round_trips = {}
+
+
+def get_storage_client(credentials=None):
+    global storage_client
+    with clients_lock:
+        if storage_client is None:
+            if os.environ.get('GCP_IO_BACKEND') == 'fake':
+                storage_client = FakeStorageClient(
+                    os.environ.get('GCP_IO_FAKE_DIR', 'fake_gcs'))
+            else:
+                project_id = None
+                if credentials:
+                    project_id = credentials.project_id
+                storage_client = storage.Client(
+                    project=project_id, credentials=credentials)
+                # 並列実行時にコネクションを使い回せるようにプールを広げる
+                adapter = HTTPAdapter(
+                    pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+                storage_client._http.mount('https://', adapter)
+
+    return storage_client
+
+
+def get_bucket(bucket_name, credentials=None):
+    # get_bucket()のメタデータ取得を行わず、バケットのハンドルのみを作る
+    if bucket_name not in buckets:
+        buckets[bucket_name] = get_storage_client(
+            credentials).bucket(bucket_name)
+
+    return buckets[bucket_name]
+
+
+def get_publisher(credentials=None):
+    global publisher_client
+    with clients_lock:
+        if publisher_client is None:
+            if os.environ.get('GCP_IO_BACKEND') == 'fake':
+                publisher_client = FakePublisherClient()
+            else:
+                publisher_client = pubsub_v1.PublisherClient(
+                    batch_settings=PUBLISH_BATCH_SETTINGS, credentials=credentials)
+
+    return publisher_client
+
+
+def get_json(bucket_name, blob_path, credentials=None):
+    bucket = get_bucket(bucket_name, credentials=credentials)
+    # ファイルがない場合は、Noneを返す
+    data = None
+    blob = bucket.get_blob(blob_path)
+    if blob:
+        data = json.loads(blob.download_as_string())
+
+    return data
+
+
+def upload_json(bucket_name, blob_path, data, credentials=None):
+    bucket = get_bucket(bucket_name, credentials=credentials)
+    upload_blob = bucket.blob(blob_path)
+    json_data = json.dumps(data, ensure_ascii=False, default=json_serial)
+    upload_blob.upload_from_string(
+        json_data, content_type='application/json')
+
+
+def create_json(bucket_name, blob_path, data, credentials=None):
+    # 存在しない場合のみ作成し、作成した場合はTrueを返す
+    bucket = get_bucket(bucket_name, credentials=credentials)
+    upload_blob = bucket.blob(blob_path)
+    json_data = json.dumps(data, ensure_ascii=False, default=json_serial)
+    try:
+        upload_blob.upload_from_string(
+            json_data, content_type='application/json', if_generation_match=0)
+    except exceptions.PreconditionFailed:
+        return False
+
+    return True
+
+
+def get_blob_list(bucket_name, prefix, delimiter=None, credentials=None):
+    bucket = get_bucket(bucket_name, credentials=credentials)
+    blob_list = bucket.list_blobs(prefix=f'{prefix}/', delimiter=delimiter)
+    return blob_list
+
+
+def get_blob_names(bucket_name, prefix, credentials=None):
+    # 名前のみを取得して、転送量を減らす
+    bucket = get_bucket(bucket_name, credentials=credentials)
+    blob_list = bucket.list_blobs(
+        prefix=f'{prefix}/', fields='items(name),nextPageToken', page_size=LIST_PAGE_SIZE)
+    return (x.name for x in blob_list)
+
+
+def publish_message(topic_name, project_id, message, attributes={}, credentials=None):
+    publisher = get_publisher(credentials=credentials)
+
+    topic_path = publisher.topic_path(project_id, topic_name)
+    future = publisher.publish(topic_path, str(
+        message).encode('utf-8'), **attributes)
+
+    return future.result()
+
+
+def publish_messages(topic_name, project_id, messages, attributes={}, credentials=None):
+    # すべて送信してから結果を待ち、メッセージごとに(メッセージ, 結果, 例外)を返す
+    publisher = get_publisher(credentials=credentials)
+
+    topic_path = publisher.topic_path(project_id, topic_name)
+    futures = [publisher.publish(topic_path, str(x).encode(
+        'utf-8'), **attributes) for x in messages]
+
+    results = []
+    for message, future in zip(messages, futures):
+        try:
+            results.append((message, future.result(), None))
+        except Exception as e:
+            results.append((message, None, e))
+
+    return results
+
+
+def json_serial(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    # 辞書への変換を、書き込む直前に1件ずつ行う
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+
+    return obj
+
+
+def count_round_trip(name):
+    with clients_lock:
+        round_trips[name] = round_trips.get(name, 0) + 1
+
+
+def print_round_trips():
+    # フェイクのバックエンドを使用した場合のみ集計される
+    if not round_trips:
+        return
+    total = sum(round_trips.values())
+    print(f'round trips: {total} {json.dumps(round_trips, sort_keys=True)}')
+
+
+class FakeStorageClient(object):
+    def __init__(self, root_dir):
+        self.root_dir = Path(root_dir)
+
+    def bucket(self, bucket_name):
+        return FakeBucket(self.root_dir / bucket_name)
+
+    def get_bucket(self, bucket_name):
+        count_round_trip('get_bucket')
+        return self.bucket(bucket_name)
+
+
+class FakeBucket(object):
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def blob(self, blob_path):
+        return FakeBlob(self, blob_path)
+
+    def get_blob(self, blob_path):
+        count_round_trip('get_blob')
+        blob = self.blob(blob_path)
+        if not blob.path.exists():
+            return None
+        blob.load_metadata()
+
+        return blob
+
+    def list_blobs(self, prefix='', delimiter=None, fields=None, page_size=None):
+        count_round_trip('list_blobs')
+        blobs = []
+        for path in sorted(self.root_dir.glob('**/*')):
+            name = path.relative_to(self.root_dir).as_posix()
+            if not path.is_file() or not name.startswith(prefix):
+                continue
+            if delimiter and delimiter in name[len(prefix):]:
+                continue
+            blob = self.blob(name)
+            blob.load_metadata()
+            blobs.append(blob)
+
+        return iter(blobs)
+
+
+class FakeBlob(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = bucket.root_dir / name
+        self.generation = None
+        self.metageneration = None
+        self.size = None
+        self.updated = None
+
+    def load_metadata(self):
+        stat = self.path.stat()
+        self.generation = stat.st_mtime_ns
+        self.metageneration = 1
+        self.size = stat.st_size
+        self.updated = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+
+    def reload(self):
+        count_round_trip('reload')
+        if not self.path.exists():
+            raise exceptions.NotFound(self.name)
+        self.load_metadata()
+
+    def exists(self):
+        count_round_trip('exists')
+        return self.path.exists()
+
+    def download_as_bytes(self, if_generation_match=None, if_generation_not_match=None, **kwargs):
+        count_round_trip('download')
+        if not self.path.exists():
+            raise exceptions.NotFound(self.name)
+        # 実際のAPIと同様に、ダウンロード時に世代を更新する
+        self.load_metadata()
+        if if_generation_match is not None and if_generation_match != self.generation:
+            raise exceptions.PreconditionFailed(self.name)
+        if if_generation_not_match is not None and if_generation_not_match == self.generation:
+            raise exceptions.NotModified(self.name)
+        return self.path.read_bytes()
+
+    def download_as_string(self, **kwargs):
+        return self.download_as_bytes(**kwargs)
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs):
+        count_round_trip('upload')
+        current_generation = self.path.stat().st_mtime_ns if self.path.exists() else 0
+        if if_generation_match is not None and if_generation_match != current_generation:
+            raise exceptions.PreconditionFailed(self.name)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_bytes(data)
+        self.load_metadata()
+
+    def delete(self):
+        count_round_trip('delete')
+        if not self.path.exists():
+            raise exceptions.NotFound(self.name)
+        self.path.unlink()
+
+    def open(self, mode='r', encoding=None, **kwargs):
+        if 'r' in mode:
+            data = self.download_as_bytes()
+            return io.BytesIO(data) if 'b' in mode else io.StringIO(data.decode(encoding or 'utf-8'))
+
+        return FakeBlobWriter(self, 'b' in mode, encoding or 'utf-8', kwargs.get('content_type'))
+
+
+class FakeBlobWriter(object):
+    def __init__(self, blob, binary, encoding, content_type):
+        self.blob = blob
+        self.buffer = io.BytesIO() if binary else io.StringIO()
+        self.encoding = encoding
+        self.content_type = content_type
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def close(self):
+        data = self.buffer.getvalue()
+        if isinstance(data, str):
+            data = data.encode(self.encoding)
+        self.blob.upload_from_string(data, content_type=self.content_type)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakePublisherClient(object):
+    def __init__(self):
+        self.messages = []
+
+    def topic_path(self, project_id, topic_name):
+        return f'projects/{project_id}/topics/{topic_name}'
+
+    def publish(self, topic_path, data, **attributes):
+        count_round_trip('publish')
+        self.messages.append((topic_path, data, attributes))
+        future = Future()
+        future.set_result(str(len(self.messages)))
+
+        return future
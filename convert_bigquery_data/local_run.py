@@ -1,19 +1,34 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import time
 import yaml
-import ndjson
+import multiprocessing
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from google.oauth2.service_account import Credentials
-from google.cloud import storage
+from gcp_io import get_bucket, LIST_PAGE_SIZE
+from bigquery_sink import get_bigquery_sink
 from main import main
 
+DEFAULT_BACKFILL_CONCURRENCY = 4
+# 同じチャンネルの動画を同じプロセスで処理し、動画一覧のキャッシュを効かせる
+# BigQueryへのロードも、この件数の動画をまとめて1回にする
+BACKFILL_CHUNK_SIZE = 32
+MANIFEST_SAVE_INTERVAL = 100
+
 
 def local_run():
     bucket_name = os.environ.get('GCS_BUCKET_NAME')
     gcp_credentials_path = os.environ.get('GCP_CREDENTIALS_PATH')
     comments_prefix = os.environ.get('GCS_COMMENTS_PREFIX').rstrip('/')
     bigquery_prefix = os.environ.get('GCS_BIGQUERY_PREFIX').rstrip('/')
+    parquet_prefix = os.environ.get('GCS_PARQUET_PREFIX', '').rstrip('/')
+    concurrency = int(os.environ.get(
+        'BACKFILL_CONCURRENCY', DEFAULT_BACKFILL_CONCURRENCY))
+    manifest_path = os.environ.get(
+        'BACKFILL_MANIFEST_PATH', 'backfill_manifest.json')
 
     credentials = None
     if gcp_credentials_path and os.path.exists(gcp_credentials_path):
@@ -21,49 +36,133 @@ def local_run():
             gcp_credentials_path)
         print(f'load credential file {gcp_credentials_path}')
 
-    blob_list = get_blob_list(
-        bucket_name, comments_prefix, credentials=credentials)
+    # 入力と出力をそれぞれ1回ずつ一覧し、出力のダウンロードは行わない
+    input_updated = get_input_updated(
+        bucket_name, comments_prefix, parquet_prefix=parquet_prefix, credentials=credentials)
+    output_updated = get_updated(
+        bucket_name, bigquery_prefix, credentials=credentials)
+    manifest = load_manifest(manifest_path)
+    print(
+        f'input blobs: {len(input_updated)}, output blobs: {len(output_updated)}, manifest: {len(manifest)}')
 
-    for blob in blob_list:
-        input_path = Path(blob.name)
+    pending = []
+    for blob_name, updated in sorted(input_updated.items()):
+        input_path = Path(blob_name)
         channel_id = str(input_path.parents[0].name)
         video_id = str(input_path.stem)
-        output_path = str(f'{bigquery_prefix}/{channel_id}/{video_id}.ndjson')
-        # すでにデータが有る場合は無視
-        if get_ndjson(bucket_name, output_path, credentials=credentials):
-            print(f'skip blob: {blob.name}')
+        output_path = f'{bigquery_prefix}/{channel_id}/{video_id}.ndjson'
+        # 変換済みの更新日時が同じ場合は、出力がなくても(対象外の動画など)スキップ
+        if manifest.get(blob_name) == updated.isoformat():
+            continue
+        if output_path in output_updated and output_updated[output_path] >= updated:
+            manifest[blob_name] = updated.isoformat()
             continue
+        pending.append(blob_name)
+    print(f'convert blobs: {len(pending)}, skip blobs: {len(input_updated) - len(pending)}')
+
+    # 親プロセスのクライアントを引き継がないように、spawnで子プロセスを起動する
+    start = time.perf_counter()
+    failed = []
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=concurrency, mp_context=context) as executor:
+        chunks = [pending[i:i + BACKFILL_CHUNK_SIZE]
+                  for i in range(0, len(pending), BACKFILL_CHUNK_SIZE)]
+        futures = [executor.submit(convert_blobs, x) for x in chunks]
+        done = 0
+        for future in as_completed(futures):
+            results = future.result()
+            for blob_name, error in results:
+                if error:
+                    print(f'failed to convert blob: {blob_name}, {error}')
+                    failed.append(blob_name)
+                else:
+                    manifest[blob_name] = input_updated[blob_name].isoformat()
+            if (done + len(results)) // MANIFEST_SAVE_INTERVAL != done // MANIFEST_SAVE_INTERVAL:
+                save_manifest(manifest_path, manifest)
+            done += len(results)
+            elapsed = time.perf_counter() - start
+            print(
+                f'converted: {done}/{len(pending)}, {done / elapsed:.1f} blobs/sec')
+    save_manifest(manifest_path, manifest)
+
+    elapsed = time.perf_counter() - start
+    print(f'backfill complete: {len(pending) - len(failed)} converted, {len(failed)} failed, {elapsed:.1f} sec')
+
+
+def convert_blobs(blob_names):
+    # 失敗しても他の変換を止めないように、例外を結果として返す
+    sink = get_bigquery_sink()
+    if sink:
+        sink.deferred = True
+    results = []
+    for blob_name in blob_names:
+        try:
+            main({'name': blob_name}, None)
+        except Exception as e:
+            results.append((blob_name, repr(e)))
+        else:
+            results.append((blob_name, None))
+
+    # ロードに失敗した場合は、まとめた動画をすべて失敗として扱う
+    if sink:
+        try:
+            sink.flush()
+        except Exception as e:
+            return [(x, error or repr(e)) for x, error in results]
+
+    return results
+
+
+def get_updated(bucket_name, prefix, credentials=None):
+    bucket = get_bucket(bucket_name, credentials=credentials)
+    blob_list = bucket.list_blobs(
+        prefix=f'{prefix}/', fields='items(name,updated),nextPageToken', page_size=LIST_PAGE_SIZE)
+
+    return {x.name: x.updated for x in blob_list}
+
+
+def get_input_updated(bucket_name, comments_prefix, parquet_prefix=None, credentials=None):
+    # 取得途中のパートも変換に含まれるため、パートの更新日時も反映する
+    # parquet_prefixを指定した場合は、まとめたコメントはJSONではなくParquetで保存されている
+    input_updated = {}
+    parts_updated = {}
+    for blob_name, updated in get_updated(bucket_name, comments_prefix, credentials=credentials).items():
+        if '.parts/' in blob_name:
+            video_path = blob_name.split('.parts/')[0]
+            if parquet_prefix:
+                blob_name = f'{parquet_prefix}{video_path[len(comments_prefix):]}.parquet'
+            else:
+                blob_name = f'{video_path}.json'
+            parts_updated[blob_name] = max(
+                updated, parts_updated.get(blob_name, updated))
+        elif blob_name.endswith('.json') and not parquet_prefix:
+            input_updated[blob_name] = updated
+    if parquet_prefix:
+        for blob_name, updated in get_updated(bucket_name, parquet_prefix, credentials=credentials).items():
+            if blob_name.endswith('.parquet'):
+                input_updated[blob_name] = updated
+
+    for blob_name in input_updated:
+        if blob_name in parts_updated:
+            input_updated[blob_name] = max(
+                input_updated[blob_name], parts_updated[blob_name])
+
+    return input_updated
+
+
+def load_manifest(manifest_path):
+    # 変換したときの入力の更新日時を、ファイル名ごとに保持する
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
 
-        print(f'convert blob: {blob.name}')
-        event = {'name': blob.name}
-        main(event, None)
-
-
-def get_blob_list(bucket_name, prefix, delimiter=None, credentials=None):
-    project_id = None
-    if credentials:
-        project_id = credentials.project_id
-    storage_client = storage.Client(
-        project=project_id, credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
-    blob_list = bucket.list_blobs(prefix=f'{prefix}/', delimiter=delimiter)
-    return blob_list
-
-
-def get_ndjson(bucket_name, blob_path, credentials=None):
-    project_id = None
-    if credentials:
-        project_id = credentials.project_id
-    storage_client = storage.Client(
-        project=project_id, credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
-    # ファイルがない場合は、Noneを返す
-    data = None
-    blob = bucket.get_blob(blob_path)
-    if blob:
-        data = ndjson.loads(blob.download_as_string())
-
-    return data
+def save_manifest(manifest_path, manifest):
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
 
 
 if __name__ == '__main__':
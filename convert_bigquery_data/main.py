@@ -4,11 +4,16 @@ import os
 import sys
 import json
 import yaml
-import ndjson
-from datetime import datetime
+import itertools
 from pathlib import Path
 from google.oauth2.service_account import Credentials
-from google.cloud import storage
+from gcp_io import get_bucket, json_serial, print_round_trips
+from videos_cache import get_videos_cache
+from bigquery_sink import get_bigquery_sink
+
+# resumable uploadのチャンクサイズは256KBの倍数にする
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+READ_SIZE = 1024 * 1024
 
 
 def main(event, context):
@@ -17,6 +22,8 @@ def main(event, context):
     videos_prefix = os.environ.get('GCS_VIDEOS_PREFIX').rstrip('/')
     comments_prefix = os.environ.get('GCS_COMMENTS_PREFIX').rstrip('/')
     bigquery_prefix = os.environ.get('GCS_BIGQUERY_PREFIX').rstrip('/')
+    # コメントをParquetで保存している場合は、Parquetの保存先も対象にする
+    parquet_prefix = os.environ.get('GCS_PARQUET_PREFIX', '').rstrip('/')
 
     credentials = None
     if gcp_credentials_path and os.path.exists(gcp_credentials_path):
@@ -25,82 +32,160 @@ def main(event, context):
         print(f'load credential file "{gcp_credentials_path}')
 
     finalized_blob_path = event['name']
-    if not finalized_blob_path.startswith(f'{comments_prefix}/'):
+    is_parquet = bool(parquet_prefix) and finalized_blob_path.startswith(
+        f'{parquet_prefix}/')
+    if not finalized_blob_path.startswith(f'{comments_prefix}/') and not is_parquet:
         print(
             f'updated blob({finalized_blob_path}) does not contaion prefix({comments_prefix}/)')
         return
 
+    # 取得途中のパートは、まとめられた後に変換する
+    if '.parts/' in finalized_blob_path:
+        print(f'skip comments part: {finalized_blob_path}')
+        return
+
     input_path = Path(finalized_blob_path)
     channel_id = str(input_path.parents[0].name)
     video_id = str(input_path.stem)
     output_path = str(f'{bigquery_prefix}/{channel_id}/{video_id}.ndjson')
+    parts_prefix = f'{comments_prefix}/{channel_id}/{video_id}.parts'
     videos_path = f'{videos_prefix}/{channel_id}.json'
 
     # ビデオ一覧にない場合はスキップ
-    channel_videos = get_json(
-        bucket_name, videos_path, credentials=credentials)
-    if not channel_videos:
-        print(f'not found video: {video_id}')
-        return
-
-    video = [x for x in channel_videos if x['video_id'] == video_id]
+    video = get_videos_cache().get_video(
+        bucket_name, videos_path, video_id, credentials=credentials)
     if not video:
         print(f'not found video: {video_id}')
         return
 
-    video = video[0]
-
     print(f'load input blob: {finalized_blob_path}')
-    data = get_json(bucket_name, finalized_blob_path, credentials=credentials)
-    if not data:
+    data = iter_comments(bucket_name, finalized_blob_path, parts_prefix,
+                         credentials=credentials)
+    # 空の場合は出力しないため、最初の1件のみ先に読み込む
+    first_item = next(data, None)
+    if first_item is None:
         print(f'not found: {finalized_blob_path}')
         return
 
-    for item in data:
+    items = enrich_comments(itertools.chain([first_item], data), video)
+    # BIGQUERY_TABLEを指定した場合は、NDJSONと同じ行をBigQueryにも書き込む
+    sink = get_bigquery_sink()
+    if sink:
+        items = sink.tee(items)
+    try:
+        count = upload_ndjson(bucket_name, output_path,
+                              items, credentials=credentials)
+    except Exception:
+        if sink and not sink.deferred:
+            sink.clear()
+        raise
+    print(f'upload complete: {output_path}, count: {count}')
+
+    if sink and not sink.deferred:
+        sink.flush()
+
+
+def enrich_comments(comments, video):
+    for item in comments:
         item['video_id'] = video['video_id']
         item['channel_id'] = video['channel_id']
         item['title'] = video['title']
         item['published_at'] = video['published_at']
         item['duration'] = video['duration']
+        yield item
 
-    upload_ndjson(bucket_name, output_path, data, credentials=credentials)
-    print(f'upload complete: {output_path}')
 
+def iter_comments(bucket_name, blob_path, parts_prefix, credentials=None):
+    # まとめられたファイル(JSONまたはParquet)と、取得途中のパートの両方を1件ずつ読み込む
+    bucket = get_bucket(bucket_name, credentials=credentials)
 
-def get_json(bucket_name, blob_path, credentials=None):
-    project_id = None
-    if credentials:
-        project_id = credentials.project_id
-    storage_client = storage.Client(
-        project=project_id, credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
-    # ファイルがない場合は、Noneを返す
-    data = None
     blob = bucket.get_blob(blob_path)
-    if blob:
-        data = json.loads(blob.download_as_string())
-
-    return data
+    part_blobs = sorted([x for x in bucket.list_blobs(prefix=f'{parts_prefix}/')
+                         if x.name.endswith('.json')], key=lambda x: x.name)
+    # パートがある場合のみ、重複確認のためにIDを保持する
+    comment_ids = set() if part_blobs else None
+    read_blob = iter_parquet_comments if blob_path.endswith(
+        '.parquet') else iter_blob_comments
+    readers = [(blob, read_blob)] if blob else []
+    readers += [(x, iter_part_comments) for x in part_blobs]
+    for input_blob, read_comments in readers:
+        for comment in read_comments(input_blob):
+            if comment_ids is not None:
+                if comment['id'] in comment_ids:
+                    continue
+                comment_ids.add(comment['id'])
+            yield comment
+
+
+def iter_blob_comments(input_blob):
+    with input_blob.open('r', encoding='utf-8', chunk_size=STREAM_CHUNK_SIZE) as f:
+        chunks = iter(lambda: f.read(READ_SIZE), '')
+        yield from iter_json_array(chunks)
+
+
+def iter_parquet_comments(input_blob):
+    # Parquetは列ごとに圧縮されているため、1回で読み込む
+    # Parquetを読み込む場合のみ、pyarrowを読み込む
+    from comment_parquet import loads_parquet
+    yield from loads_parquet(input_blob.download_as_string())
+
+
+def iter_part_comments(part_blob):
+    # パート(チェックポイント)はコメントとcontinuationを持つオブジェクト、旧形式はコメントの配列
+    # 一定間隔ごとに保存されるため、1回で読み込む
+    data = json.loads(part_blob.download_as_string())
+    yield from data['comments'] if isinstance(data, dict) else data
+
+
+def iter_json_array(chunks):
+    # JSON配列全体を読み込まず、要素ごとに順次返す
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError(f'not a JSON array: {buffer[pos:pos + 20]}')
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == ']':
+                return
+
+            # 要素の途中で区切られている場合は、次のチャンクを待つ
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break
+            yield item
+
+    if buffer[pos:].strip():
+        raise ValueError(f'incomplete JSON array: {buffer[pos:pos + 20]}')
 
 
 def upload_ndjson(bucket_name, blob_path, data, credentials=None):
-    project_id = None
-    if credentials:
-        project_id = credentials.project_id
-    storage_client = storage.Client(
-        project=project_id, credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = get_bucket(bucket_name, credentials=credentials)
     upload_blob = bucket.blob(blob_path)
-    json_data = ndjson.dumps(data, ensure_ascii=False, default=json_serial)
-    upload_blob.upload_from_string(
-        json_data, content_type='application/x-ndjson')
-
-
-def json_serial(obj):
-    if isinstance(obj, datetime):
-        return obj.isoformat()
+    # 全体を文字列にせず、1行ずつresumable uploadで書き込む
+    count = 0
+    with upload_blob.open('w', encoding='utf-8', chunk_size=STREAM_CHUNK_SIZE,
+                          content_type='application/x-ndjson') as f:
+        for item in data:
+            f.write(json.dumps(item, ensure_ascii=False, default=json_serial))
+            f.write('\n')
+            count += 1
 
-    return obj
+    return count
 
 
 if __name__ == '__main__':
@@ -113,3 +198,4 @@ if __name__ == '__main__':
     event = {'name': sys.argv[1]}
 
     main(event, None)
+    print_round_trips()
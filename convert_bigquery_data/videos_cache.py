@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import threading
+from collections import OrderedDict
+from google.api_core import exceptions
+from gcp_io import get_bucket
+
+# 関数の実行間で動画一覧を使い回し、世代が変わった場合のみダウンロードする
+# 容量はダウンロードしたJSONのバイト数で計算する
+DEFAULT_VIDEOS_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+videos_cache_lock = threading.Lock()
+videos_cache = None
+
+
+def get_videos_cache():
+    global videos_cache
+    with videos_cache_lock:
+        if videos_cache is None:
+            videos_cache = VideosCache(int(os.environ.get(
+                'VIDEOS_CACHE_MAX_BYTES', DEFAULT_VIDEOS_CACHE_MAX_BYTES)))
+
+    return videos_cache
+
+
+class VideosCacheEntry(object):
+    __slots__ = ('generation', 'size', 'videos')
+
+    def __init__(self, generation, size, videos):
+        self.generation = generation
+        self.size = size
+        self.videos = videos
+
+
+class VideosCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.stats = {'hit': 0, 'miss': 0, 'evict': 0}
+
+    def get_video(self, bucket_name, blob_path, video_id, credentials=None):
+        # 動画一覧がない場合や、一覧にない動画の場合はNoneを返す
+        videos = self.get_videos(bucket_name, blob_path, credentials=credentials)
+        if videos is None:
+            return None
+
+        return videos.get(video_id)
+
+    def get_videos(self, bucket_name, blob_path, credentials=None):
+        # video_idをキーにした辞書を返す
+        key = (bucket_name, blob_path)
+        with self.lock:
+            entry = self.entries.get(key)
+
+        blob = get_bucket(bucket_name, credentials=credentials).blob(blob_path)
+        try:
+            # 同じ世代の場合は、本文を転送せずに304が返る
+            data = blob.download_as_bytes(
+                if_generation_not_match=entry.generation if entry else None)
+        except exceptions.NotModified:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                self.stats['hit'] += 1
+            return entry.videos
+        except exceptions.NotFound:
+            self.remove(key)
+            return None
+
+        videos = {x['video_id']: x for x in json.loads(data)}
+        self.put(key, VideosCacheEntry(blob.generation, len(data), videos))
+
+        return videos
+
+    def put(self, key, entry):
+        with self.lock:
+            self.stats['miss'] += 1
+            self.remove_entry(key)
+            # 上限を超える大きさのファイルは保持しない
+            if entry.size > self.max_bytes:
+                return
+            self.entries[key] = entry
+            self.total_bytes += entry.size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+                self.stats['evict'] += 1
+
+    def remove(self, key):
+        with self.lock:
+            self.remove_entry(key)
+
+    def remove_entry(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.total_bytes -= entry.size
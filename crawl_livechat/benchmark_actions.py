@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import tracemalloc
+from youtube_livechat_scraper import YoutubeLiveChatScraper
+from ytinitialdata_extractor import extract_chat_actions
+
+ACTIONS_PER_PAGE = 1000
+
+
+def create_renderer(i):
+    renderer = {
+        'message': {'runs': [{'text': f'comment {i}'}]},
+        'authorName': {'simpleText': f'author{i % 5000}'},
+        'authorPhoto': {'thumbnails': [{'url': f'https://yt3.ggpht.com/{i}/s32', 'width': 32, 'height': 32},
+                                       {'url': f'https://yt3.ggpht.com/{i}/s64', 'width': 64, 'height': 64}]},
+        'contextMenuEndpoint': {'commandMetadata': {'webCommandMetadata': {'ignoreNavigation': True}},
+                                'liveChatItemContextMenuEndpoint': {'params': 'Q2g' * 40}},
+        'id': f'Ch{i:024d}',
+        'timestampUsec': str(1609459200000000 + i * 100000),
+        'authorExternalChannelId': f'UC{i % 5000:022d}',
+        'timestampText': {'simpleText': f'{i // 600}:{i // 10 % 60:02d}'},
+    }
+    if i % 50 == 0:
+        renderer['purchaseAmountText'] = {'simpleText': '¥500'}
+
+    return renderer
+
+
+def create_action(i):
+    # 取得対象外のティッカーやエンゲージメントメッセージも含める
+    if i % 10 == 3:
+        item = {'liveChatViewerEngagementMessageRenderer': {
+            'id': f'En{i}', 'message': {'runs': [{'text': 'x' * 200}]}}}
+        chat_action = {'addChatItemAction': {'item': item, 'clientId': ''}}
+    elif i % 10 == 7:
+        ticker = {'liveChatTickerPaidMessageItemRenderer': {
+            'id': f'Ti{i}',
+            'showItemEndpoint': {'showLiveChatItemEndpoint': {'renderer': {
+                'liveChatPaidMessageRenderer': create_renderer(i)}}}}}
+        chat_action = {'addLiveChatTickerItemAction': {
+            'item': ticker, 'durationSec': '300'}}
+    elif i % 10 == 9:
+        chat_action = {'addChatItemAction': {'item': {'liveChatMembershipItemRenderer': {
+            'id': f'Me{i}', 'timestampUsec': str(1609459200000000 + i * 100000),
+            'authorExternalChannelId': f'UC{i:022d}', 'authorName': {'simpleText': f'member{i}'},
+            'headerSubtext': {'runs': [{'text': 'Welcome'}]}}}}}
+    else:
+        chat_action = {'addChatItemAction': {
+            'item': {'liveChatTextMessageRenderer' if i % 50 else 'liveChatPaidMessageRenderer': create_renderer(i)},
+            'clientId': ''}}
+
+    return {'replayChatItemAction': {'actions': [chat_action], 'videoOffsetTimeMsec': str(i * 100)}}
+
+
+def create_page(page):
+    actions = [create_action(page * ACTIONS_PER_PAGE + i)
+               for i in range(ACTIONS_PER_PAGE)]
+    data = {
+        'responseContext': {'serviceTrackingParams': [{'service': 'CSI', 'params': [{'key': 'c', 'value': 'WEB'}]}]},
+        'continuationContents': {'liveChatContinuation': {
+            'continuations': [{'liveChatReplayContinuationData': {'continuation': f'op2w{page + 1}', 'timeUntilLastMessageMsec': 5000}},
+                              {'playerSeekContinuationData': {'continuation': f'seek{page}'}}],
+            'actions': actions}}}
+
+    return json.dumps(data, ensure_ascii=False)
+
+
+def full_decode(scraper, text):
+    # 変更前の実装: 全体をJSONとして読み込んでから必要なレンダラーを探す
+    livechat_continuation = json.loads(
+        text)['continuationContents']['liveChatContinuation']
+    actions = livechat_continuation['actions']
+    next_continuation = None
+    for c in livechat_continuation['continuations']:
+        if 'liveChatReplayContinuationData' in c:
+            next_continuation = c['liveChatReplayContinuationData']['continuation']
+            break
+
+    return scraper.parse_actions(actions), next_continuation
+
+
+def selective_decode(scraper, text):
+    actions, next_continuation = extract_chat_actions(
+        text, scraper.renderer_types)
+
+    return scraper.parse_actions(actions), next_continuation
+
+
+def measure(name, decode, scraper, pages):
+    start = time.perf_counter()
+    results = [decode(scraper, x) for x in pages]
+    elapsed = time.perf_counter() - start
+
+    # 計測のオーバーヘッドを避けるため、メモリは別に解析して計測する
+    tracemalloc.start()
+    for text in pages:
+        decode(scraper, text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = sum(len(x) for x, _ in results)
+    print(f'{len(pages)} pages: {name} {len(pages) / elapsed:.2f} pages/sec, '
+          f'{count / elapsed:.0f} comments/sec, peak memory: {peak / 1024 / 1024:.2f} MiB')
+
+    return [([x.to_dict() for x in comments], c) for comments, c in results]
+
+
+def benchmark(page_count):
+    pages = [create_page(i) for i in range(page_count)]
+    scraper = YoutubeLiveChatScraper()
+    full_results = measure('full', full_decode, scraper, pages)
+    selective_results = measure('selective', selective_decode, scraper, pages)
+    if full_results != selective_results:
+        raise Exception('decoded comments are different')
+
+    scraper = YoutubeLiveChatScraper(
+        extra_renderers=('liveChatMembershipItemRenderer',))
+    full_results = measure('full+membership', full_decode, scraper, pages)
+    selective_results = measure(
+        'selective+membership', selective_decode, scraper, pages)
+    if full_results != selective_results:
+        raise Exception('decoded comments are different')
+
+
+if __name__ == '__main__':
+    counts = [int(x) for x in sys.argv[1:]] or [10, 100]
+    for count in counts:
+        benchmark(count)
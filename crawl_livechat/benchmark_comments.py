@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import tracemalloc
+from datetime import datetime
+from youtube_livechat_scraper import YoutubeLiveChatScraper
+from gcp_io import json_serial
+
+EMOJI_COUNT = 20
+
+
+def create_renderer(i):
+    runs = [{'text': f'comment {i} '}]
+    for k in range(i % 4):
+        emoji_id = f'emoji{(i + k) % EMOJI_COUNT}'
+        runs.append({'emoji': {'emojiId': emoji_id, 'image': {
+            'accessibility': {'accessibilityData': {'label': emoji_id}}}}})
+        runs.append({'text': ' w'})
+    renderer = {
+        'id': f'Ch{i:024d}',
+        'timestampUsec': str(1609459200000000 + i * 100000),
+        'timestampText': {'simpleText': f'{i // 600}:{i // 10 % 60:02d}'},
+        'authorExternalChannelId': f'UC{i % 5000:022d}',
+        'authorName': {'simpleText': f'author{i % 5000}'},
+        'message': {'runs': runs},
+    }
+    if i % 50 == 0:
+        renderer['purchaseAmountText'] = {'simpleText': '¥500'}
+
+    return renderer
+
+
+def dict_parse_comment(renderer):
+    # 変更前の辞書による実装
+    item = {}
+    if 'purchaseAmountText' in renderer:
+        item['amountString'] = renderer['purchaseAmountText']['simpleText']
+        item['type'] = 'superChat'
+    else:
+        item['type'] = 'textMessage'
+    item['id'] = renderer['id']
+    item['timestamp'] = int(renderer['timestampUsec']) / 1000000
+    item['datetime'] = datetime.fromtimestamp(item['timestamp'])
+    item['elapsedTime'] = renderer['timestampText']['simpleText']
+    item['author'] = {
+        'channelId': renderer['authorExternalChannelId'],
+        'name': renderer['authorName']['simpleText']
+    }
+    message = ''
+    if 'message' in renderer:
+        for run in renderer['message']['runs']:
+            if 'text' in run:
+                message += run['text']
+            elif 'emoji' in run:
+                emoji = run['emoji']['image']['accessibility']['accessibilityData']['label']
+                message += f':{emoji}:'
+        item['message'] = message
+
+    return item
+
+
+def measure(name, parse, renderers):
+    start = time.perf_counter()
+    comments = [parse(x) for x in renderers]
+    parse_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    data = json.dumps(comments, ensure_ascii=False, default=json_serial)
+    dumps_elapsed = time.perf_counter() - start
+
+    # 計測のオーバーヘッドを避けるため、メモリは別に解析して計測する
+    del comments
+    tracemalloc.start()
+    comments = [parse(x) for x in renderers]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # 計測後に解放する
+    del comments
+    print(f'{len(renderers)}: {name} {len(renderers) / parse_elapsed:.0f} comments/sec, '
+          f'{memory / len(renderers):.0f} bytes/comment, '
+          f'parse {parse_elapsed * 1000:.2f} ms + dumps {dumps_elapsed * 1000:.2f} ms')
+
+    return data
+
+
+def benchmark(count):
+    renderers = [create_renderer(i) for i in range(count)]
+    scraper = YoutubeLiveChatScraper()
+    dict_data = measure('dict', dict_parse_comment, renderers)
+    record_data = measure('record', scraper.parse_comment, renderers)
+    if dict_data != record_data:
+        raise Exception('serialized comments are different')
+
+
+if __name__ == '__main__':
+    counts = [int(x) for x in sys.argv[1:]] or [10000, 100000, 1000000]
+    for count in counts:
+        benchmark(count)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import random
+import string
+from comment_index import CommentIdIndex
+
+NEW_COMMENTS_COUNT = 1000
+# リストでの重複判定は時間がかかるため、この件数までのみ計測する
+LIST_MAX_COUNT = 100000
+
+
+def random_id():
+    return 'Ch' + ''.join(random.choices(string.ascii_letters + string.digits, k=24))
+
+
+def benchmark(count):
+    current_ids = [random_id() for _ in range(count)]
+    # 半分は保存済みのIDと重複させる
+    new_comments = [{'id': random_id()} for _ in range(NEW_COMMENTS_COUNT // 2)] + \
+        [{'id': x} for x in random.sample(current_ids, NEW_COMMENTS_COUNT // 2)]
+
+    if count <= LIST_MAX_COUNT:
+        start = time.perf_counter()
+        added = [x for x in new_comments if x['id'] not in current_ids]
+        elapsed = time.perf_counter() - start
+        print(f'{count}: list dedup {elapsed * 1000:.2f} ms, added: {len(added)}')
+
+    start = time.perf_counter()
+    comment_index = CommentIdIndex(current_ids)
+    build_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    added = comment_index.filter_new(new_comments)
+    elapsed = time.perf_counter() - start
+    print(f'{count}: index build {build_elapsed * 1000:.2f} ms, index dedup {elapsed * 1000:.2f} ms, added: {len(added)}')
+
+    start = time.perf_counter()
+    data = comment_index.dumps()
+    dumps_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    CommentIdIndex.loads(data)
+    loads_elapsed = time.perf_counter() - start
+    print(f'{count}: index file {len(data) / 1024:.1f} KiB ({len(data) / len(comment_index):.1f} bytes/id), '
+          f'dumps {dumps_elapsed * 1000:.2f} ms, loads {loads_elapsed * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    counts = [int(x) for x in sys.argv[1:]] or [10000, 100000, 1000000]
+    for count in counts:
+        benchmark(count)
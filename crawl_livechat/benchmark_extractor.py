@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import re
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from youtube_livechat_scraper import YoutubeLiveChatScraper
+from ytinitialdata_extractor import extract_initial_data
+
+SCRIPT_RE = re.compile(r'<script[^>]*>(.*?)</script>', re.S)
+PATTERNS = (r'var\s+ytInitialData\s*=\s*(.+)',
+            r'window\["ytInitialData"\]\s*=\s*(.+)')
+
+
+def extract_by_scan(scraper, scripts):
+    for script_text in scripts:
+        data = extract_initial_data(script_text)
+        if data is not None:
+            return data
+
+    return None
+
+
+def extract_by_tokenize(scraper, scripts):
+    for script_text in scripts:
+        for line in scraper.split_js_lines(script_text):
+            for pattern in PATTERNS:
+                m = re.search(pattern, line)
+                if m:
+                    return m.group(1)
+
+    return None
+
+
+def run(name, func, pages, repeat):
+    scraper = YoutubeLiveChatScraper()
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for scripts in pages:
+            if func(scraper, scripts) is None:
+                print(f'{name}: ytInitialData not found')
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    count = len(pages) * repeat
+    print(f'{name}: {count / elapsed:.2f} pages/sec, peak memory: {peak / 1024 / 1024:.2f} MiB')
+
+
+def benchmark(fixtures_dir, repeat=1):
+    pages = []
+    for path in sorted(Path(fixtures_dir).glob('*.html')):
+        html = path.read_text(encoding='utf-8')
+        pages.append([x for x in SCRIPT_RE.findall(html) if 'ytInitialData' in x])
+    print(f'fixture pages: {len(pages)}')
+    if not pages:
+        return
+
+    run('scan', extract_by_scan, pages, repeat)
+    run('tokenize', extract_by_tokenize, pages, repeat)
+
+
+if __name__ == '__main__':
+    fixtures_dir = sys.argv[1] if len(sys.argv) >= 2 else 'fixtures'
+    repeat = int(sys.argv[2]) if len(sys.argv) >= 3 else 1
+
+    benchmark(fixtures_dir, repeat)
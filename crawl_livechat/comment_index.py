@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+from comment_record import Comment
+
+
+class CommentIdIndex(object):
+    # コメントIDの重複判定用インデックス
+    def __init__(self, comment_ids=()):
+        self.comment_ids = set(comment_ids)
+
+    def __len__(self):
+        return len(self.comment_ids)
+
+    def __contains__(self, comment_id):
+        return comment_id in self.comment_ids
+
+    def add(self, comment_id):
+        # 追加した場合はTrue、登録済みの場合はFalseを返す
+        if comment_id in self.comment_ids:
+            return False
+        self.comment_ids.add(comment_id)
+
+        return True
+
+    def filter_new(self, comments):
+        # 取得したコメント(Comment)と、保存済みのコメント(dict)の両方を受け付ける
+        return [x for x in comments if self.add(x.id if isinstance(x, Comment) else x['id'])]
+
+    def dumps(self):
+        # ソートした改行区切りのIDをgzip圧縮して保存する
+        return gzip.compress('\n'.join(sorted(self.comment_ids)).encode('utf-8'), compresslevel=1)
+
+    @classmethod
+    def loads(cls, data):
+        text = gzip.decompress(data).decode('utf-8')
+
+        return cls(text.split('\n') if text else ())
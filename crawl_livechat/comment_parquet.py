@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import io
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# BigQueryへ直接ロードできる列形式のスキーマ
+COMMENT_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('type', pa.dictionary(pa.int8(), pa.string())),
+    ('timestamp', pa.timestamp('us', tz='UTC')),
+    ('elapsedTime', pa.string()),
+    ('authorChannelId', pa.dictionary(pa.int32(), pa.string())),
+    ('authorName', pa.dictionary(pa.int32(), pa.string())),
+    ('message', pa.string()),
+    ('amountString', pa.string()),
+    ('video_id', pa.dictionary(pa.int8(), pa.string())),
+    ('channel_id', pa.dictionary(pa.int8(), pa.string())),
+])
+
+
+def comments_to_table(comments, video_id, channel_id):
+    columns = {
+        'id': [x['id'] for x in comments],
+        'type': [x['type'] for x in comments],
+        # 秒(float)ではなく、マイクロ秒の整数で保持する
+        'timestamp': [round(x['timestamp'] * 1000000) for x in comments],
+        'elapsedTime': [x['elapsedTime'] for x in comments],
+        'authorChannelId': [x['author']['channelId'] for x in comments],
+        'authorName': [x['author']['name'] for x in comments],
+        'message': [x.get('message') for x in comments],
+        'amountString': [x.get('amountString') for x in comments],
+        'video_id': [video_id] * len(comments),
+        'channel_id': [channel_id] * len(comments),
+    }
+    arrays = []
+    for field in COMMENT_SCHEMA:
+        if pa.types.is_dictionary(field.type):
+            arrays.append(dictionary_array(columns[field.name], field.type))
+        else:
+            arrays.append(pa.array(columns[field.name], type=field.type))
+
+    return pa.Table.from_arrays(arrays, schema=COMMENT_SCHEMA)
+
+
+def dictionary_array(values, dictionary_type):
+    # 投稿者などの重複の多い値は、辞書エンコードして保持する
+    dictionary = {}
+    indices = [dictionary.setdefault(x, len(dictionary)) for x in values]
+
+    return pa.DictionaryArray.from_arrays(
+        pa.array(indices, type=dictionary_type.index_type),
+        pa.array(list(dictionary), type=dictionary_type.value_type))
+
+
+def dumps_parquet(comments, video_id, channel_id):
+    table = comments_to_table(comments, video_id, channel_id)
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='zstd')
+
+    return buffer.getvalue()
+
+
+def loads_parquet(data):
+    # 保存済みのJSONと同じキー・順序のコメントの辞書に戻す(video_id、channel_idは含まない)
+    table = pq.read_table(pa.BufferReader(data))
+    columns = {name: table.column(name).to_pylist()
+               for name in table.column_names if name != 'timestamp'}
+    # datetimeではなく、マイクロ秒の整数で読み込む
+    timestamps = table.column('timestamp').cast(pa.int64()).to_pylist()
+    comments = []
+    for i, timestamp_usec in enumerate(timestamps):
+        item = {}
+        if columns['amountString'][i] is not None:
+            item['amountString'] = columns['amountString'][i]
+        item['type'] = columns['type'][i]
+        item['id'] = columns['id'][i]
+        item['timestamp'] = timestamp_usec / 1000000
+        item['datetime'] = datetime.fromtimestamp(
+            timestamp_usec / 1000000).isoformat()
+        item['elapsedTime'] = columns['elapsedTime'][i]
+        item['author'] = {
+            'channelId': columns['authorChannelId'][i],
+            'name': columns['authorName'][i]
+        }
+        if columns['message'][i] is not None:
+            item['message'] = columns['message'][i]
+        comments.append(item)
+
+    return comments
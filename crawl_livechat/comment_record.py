@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+from functools import lru_cache
+
+
+class Comment(object):
+    # 取得したコメントを辞書ではなく固定の属性で保持し、保存時にのみ辞書にする
+    __slots__ = ('id', 'type', 'timestamp_usec', 'elapsed_time',
+                 'author_channel_id', 'author_name', 'message', 'amount_string')
+
+    def __init__(self, id, type, timestamp_usec, elapsed_time, author_channel_id, author_name, message=None, amount_string=None):
+        self.id = id
+        self.type = type
+        self.timestamp_usec = timestamp_usec
+        self.elapsed_time = elapsed_time
+        self.author_channel_id = author_channel_id
+        self.author_name = author_name
+        self.message = message
+        self.amount_string = amount_string
+
+    @property
+    def timestamp(self):
+        return self.timestamp_usec / 1000000
+
+    def to_dict(self):
+        # 保存済みのJSONと同じキー・順序にする
+        item = {}
+        if self.amount_string is not None:
+            item['amountString'] = self.amount_string
+        item['type'] = self.type
+        item['id'] = self.id
+        item['timestamp'] = self.timestamp
+        item['datetime'] = format_datetime(self.timestamp_usec)
+        item['elapsedTime'] = self.elapsed_time
+        item['author'] = {
+            'channelId': self.author_channel_id,
+            'name': self.author_name
+        }
+        if self.message is not None:
+            item['message'] = self.message
+
+        return item
+
+
+@lru_cache(maxsize=4096)
+def format_seconds(seconds):
+    return datetime.fromtimestamp(seconds).isoformat()
+
+
+def format_datetime(timestamp_usec):
+    # datetime.fromtimestamp(timestamp).isoformat()と同じ文字列を、秒単位のキャッシュから作る
+    seconds, usec = divmod(timestamp_usec, 1000000)
+    if not usec:
+        return format_seconds(seconds)
+
+    return f'{format_seconds(seconds)}.{usec:06d}'
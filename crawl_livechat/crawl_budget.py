@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+
+# 指数移動平均の重み(新しい値の割合)
+EWMA_ALPHA = 0.3
+# 固定時間(レイテンシ)のみで推定する保存サイズ
+SMALL_TRANSFER_BYTES = 256 * 1024
+
+
+class Ewma(object):
+    def __init__(self, initial=None, alpha=EWMA_ALPHA):
+        self.value = initial
+        self.alpha = alpha
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+
+
+class TransferModel(object):
+    # 保存時間 = 固定時間 + バイト数 / 転送速度
+    # 小さい保存から固定時間を、大きい保存から転送速度を推定する
+    def __init__(self, latency_seconds=1.0, bytes_per_second=4 * 1024 * 1024):
+        self.lock = threading.Lock()
+        self.latency = Ewma(latency_seconds)
+        self.throughput = Ewma(bytes_per_second)
+
+    def predict(self, size):
+        with self.lock:
+            return self.latency.value + size / self.throughput.value
+
+    def add(self, size, seconds):
+        with self.lock:
+            if size < SMALL_TRANSFER_BYTES:
+                self.latency.add(seconds)
+            else:
+                self.throughput.add(
+                    size / max(seconds - self.latency.value, 0.1))
+
+
+# 同じインスタンスで続けて実行される場合は、推定値を引き継ぐ
+transfer_model = TransferModel()
+
+
+class CrawlBudget(object):
+    # 次のページの取得・解析と、その後の保存が実行時間内に終わる場合のみ取得を続ける
+    def __init__(self, duration_seconds, margin_seconds=10, get_save_bytes=None):
+        self.start = time.monotonic()
+        self.deadline = self.start + duration_seconds if duration_seconds > 0 else None
+        self.margin_seconds = margin_seconds
+        self.get_save_bytes = get_save_bytes
+        self.lock = threading.Lock()
+        self.fetch = Ewma()
+        self.parse = Ewma()
+        self.stopped = False
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+
+        return self.deadline - time.monotonic()
+
+    def add_fetch(self, seconds):
+        with self.lock:
+            self.fetch.add(seconds)
+
+    def add_parse(self, seconds):
+        with self.lock:
+            self.parse.add(seconds)
+
+    def should_stop(self):
+        # 進まないまま再実行を繰り返さないように、少なくとも1ページは取得する
+        if self.deadline is None or not self.fetch.count:
+            return False
+
+        with self.lock:
+            fetch_seconds = self.fetch.value or 0
+            parse_seconds = self.parse.value or 0
+        save_bytes = self.get_save_bytes() if self.get_save_bytes else 0
+        save_seconds = transfer_model.predict(save_bytes)
+        remaining = self.remaining()
+        required = fetch_seconds + parse_seconds + save_seconds + self.margin_seconds
+        if remaining >= required:
+            return False
+
+        # 複数のセグメントが停止する場合も、1回のみ出力する
+        with self.lock:
+            first = not self.stopped
+            self.stopped = True
+        if first:
+            log_timing('budget_stop', remaining_seconds=remaining, predicted_fetch_seconds=fetch_seconds,
+                       predicted_parse_seconds=parse_seconds, predicted_save_seconds=save_seconds,
+                       save_bytes=save_bytes, margin_seconds=self.margin_seconds,
+                       pages=self.fetch.count)
+
+        return True
+
+    def get_fetch_deadline(self):
+        # ページの取得(再試行を含む)を終える必要がある時刻
+        # 取得後の解析と保存の推定時間を残す
+        if self.deadline is None:
+            return None
+
+        with self.lock:
+            parse_seconds = self.parse.value or 0
+        save_bytes = self.get_save_bytes() if self.get_save_bytes else 0
+        save_seconds = transfer_model.predict(save_bytes)
+
+        return self.deadline - parse_seconds - save_seconds - self.margin_seconds
+
+    def can_save(self, size):
+        # 指定したサイズの保存が、残り時間内に終わるか
+        if self.deadline is None:
+            return True
+
+        return self.remaining() >= transfer_model.predict(size) + self.margin_seconds
+
+    def summary(self):
+        with self.lock:
+            log_timing('budget_summary', elapsed_seconds=time.monotonic() - self.start,
+                       remaining_seconds=self.remaining(), pages=self.fetch.count,
+                       fetch_seconds=self.fetch.value, parse_seconds=self.parse.value,
+                       transfer_latency_seconds=transfer_model.latency.value,
+                       transfer_bytes_per_second=transfer_model.throughput.value)
+
+
+def measure_transfer(event, size, func, *args, **kwargs):
+    # 保存時間の推定値と実測値を記録し、推定に反映する
+    predicted = transfer_model.predict(size)
+    start = time.monotonic()
+    result = func(*args, **kwargs)
+    actual = time.monotonic() - start
+    transfer_model.add(size, actual)
+    log_timing(event, bytes=size, predicted_seconds=predicted,
+               actual_seconds=actual)
+
+    return result
+
+
+def log_timing(event, **fields):
+    # Cloud Loggingで構造化ログとして扱われるように、1行のJSONで出力する
+    entry = {'severity': 'INFO', 'message': event, 'event': event}
+    for k, v in fields.items():
+        entry[k] = round(v, 3) if isinstance(v, float) else v
+    print(json.dumps(entry, ensure_ascii=False))
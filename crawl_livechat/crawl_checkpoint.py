@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+from pathlib import Path
+from google.api_core import exceptions
+from comment_index import CommentIdIndex
+from gcp_io import get_bucket, json_serial
+from crawl_budget import Ewma, measure_transfer
+
+# 取得途中のパート(チェックポイント)は、コメントと続きの状態を1つのオブジェクトに保存する
+#   {"continuation": "...", "comments": [...]}
+#   {"segments": [{"continuation": "...", "end_offset_ms": ...}], "comments": [...]}
+# continuationがnull、またはsegmentsが空の場合は取得完了
+
+
+class CheckpointConflictError(Exception):
+    pass
+
+
+class CrawlCheckpoint(object):
+    def __init__(self, bucket_name, parts_prefix, index_path, interval_seconds=60, credentials=None):
+        self.bucket_name = bucket_name
+        self.parts_prefix = parts_prefix
+        self.index_path = index_path
+        self.interval_seconds = interval_seconds
+        self.credentials = credentials
+        self.lock = threading.Lock()
+        self.comment_index = CommentIdIndex()
+        self.part_number = 0
+        # 保存済みの状態(パートがない、または旧形式の場合はNone)
+        self.state = None
+        self.streams = []
+        self.segmented = False
+        self.pending = []
+        self.flushed_at = time.monotonic()
+        self.flush_count = 0
+        # 保存時間の推定用(パートの合計サイズ、1件あたりのサイズ、インデックスのサイズ)
+        self.part_bytes = 0
+        self.comment_bytes = Ewma(300)
+        self.index_bytes = 0
+
+    def load(self):
+        # 最新のパートの状態と、保存済みのIDを読み込む
+        bucket = get_bucket(self.bucket_name, credentials=self.credentials)
+        part_blobs = [x for x in bucket.list_blobs(
+            prefix=f'{self.parts_prefix}/') if x.name.endswith('.json')]
+        self.part_bytes = sum(x.size or 0 for x in part_blobs)
+        if part_blobs:
+            last_blob = max(part_blobs, key=lambda x: int(Path(x.name).stem))
+            self.part_number = int(Path(last_blob.name).stem)
+            data = json.loads(last_blob.download_as_string())
+            if isinstance(data, dict):
+                self.state = {k: v for k, v in data.items() if k != 'comments'}
+
+        # インデックスがない場合は、空のインデックスを使う
+        index_blob = bucket.get_blob(self.index_path)
+        if index_blob:
+            index_data = index_blob.download_as_string()
+            self.comment_index = CommentIdIndex.loads(index_data)
+            self.index_bytes = len(index_data)
+
+        return self.state
+
+    def is_complete(self):
+        if self.state is None:
+            return False
+
+        return not self.state.get('continuation') and not self.state.get('segments')
+
+    def start(self, continuation=None, segments=None):
+        # 取得する範囲ごとの状態を、取得開始時の状態で初期化する
+        self.segmented = bool(segments)
+        self.streams = list(segments) if segments else [
+            {'continuation': continuation}]
+        self.flushed_at = time.monotonic()
+
+    def set_continuation(self, stream_index, continuation):
+        # 最初のcontinuationを取得した場合
+        with self.lock:
+            self.streams[stream_index] = {
+                'continuation': continuation} if continuation else None
+
+    def add(self, stream_index, comments, next_continuation):
+        # 1ページ分のコメントと次のcontinuationを記録し、一定間隔ごとに保存する
+        with self.lock:
+            self.pending.extend(self.comment_index.filter_new(comments))
+            stream = self.streams[stream_index]
+            self.streams[stream_index] = {
+                'continuation': next_continuation,
+                'end_offset_ms': stream.get('end_offset_ms')
+            } if next_continuation else None
+            if time.monotonic() - self.flushed_at >= self.interval_seconds:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            return self.flush_locked()
+
+    def get_flush_bytes(self):
+        # 保存していないコメントとインデックスを保存する場合のサイズ
+        with self.lock:
+            return int(len(self.pending) * self.comment_bytes.value) + self.index_bytes
+
+    def get_state(self):
+        if not self.segmented:
+            stream = self.streams[0] if self.streams else None
+            return {'continuation': stream['continuation'] if stream else None}
+
+        return {'segments': [x for x in self.streams if x]}
+
+    def flush_locked(self):
+        # 状態が変わっていない場合は保存しない
+        state = self.get_state()
+        self.flushed_at = time.monotonic()
+        if not self.pending and state == self.state:
+            return None
+
+        data = dict(state)
+        data['comments'] = self.pending
+        json_data = json.dumps(data, ensure_ascii=False,
+                               default=json_serial).encode('utf-8')
+        index_data = self.comment_index.dumps()
+        part_number = self.part_number + 1
+        blob_path = f'{self.parts_prefix}/{part_number:05d}.json'
+        measure_transfer('checkpoint_timing', len(json_data) + len(index_data),
+                         self.upload, blob_path, json_data, index_data)
+        if self.pending:
+            self.comment_bytes.add(len(json_data) / len(self.pending))
+        self.part_bytes += len(json_data)
+        self.index_bytes = len(index_data)
+        print(
+            f'checkpoint: {blob_path}, comments: {len(self.pending)}, state: {state}')
+
+        self.part_number = part_number
+        self.state = state
+        self.pending = []
+        self.flush_count += 1
+
+        return blob_path
+
+    def upload(self, blob_path, json_data, index_data):
+        bucket = get_bucket(self.bucket_name, credentials=self.credentials)
+        # 他の実行が同じ番号のパートを作成した場合は、状態が分岐しないように中断する
+        try:
+            bucket.blob(blob_path).upload_from_string(
+                json_data, content_type='application/json', if_generation_match=0)
+        except exceptions.PreconditionFailed:
+            raise CheckpointConflictError(
+                f'checkpoint already exists: {blob_path}')
+        bucket.blob(self.index_path).upload_from_string(
+            index_data, content_type='application/gzip')
+
+
+def get_part_comments(data):
+    # 旧形式のパートはコメントの配列のみ
+    return data['comments'] if isinstance(data, dict) else data
+
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import gzip
+import json
+import time
+import random
+import threading
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs, quote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 保存済みのページを返すオフライン用サーバー
+#   fixtures/watch/{video_id}.html
+#   fixtures/live_chat_replay/{continuation}.html
+#   fixtures/get_live_chat_replay/{continuation}.json
+# continuationはURLエンコードしたものをファイル名とする
+# fault_rateを指定すると、その割合のリクエストに429/5xxまたは遅延を返す(再試行の確認用)
+
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    fixtures_dir = Path('fixtures')
+    sent_bytes = 0
+    fault_rate = 0
+    fault_statuses = (429, 500, 503)
+    delay_seconds = 0
+    retry_after = None
+    fault_random = random.Random(0)
+    fault_lock = threading.Lock()
+    request_count = 0
+    fault_count = 0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/watch' and 'v' in query:
+            self.send_fixture('watch', f'{query["v"][0]}.html', 'text/html')
+        elif url.path == '/live_chat_replay' and 'continuation' in query:
+            self.send_fixture(
+                'live_chat_replay', f'{quote(query["continuation"][0], safe="")}.html', 'text/html')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/youtubei/v1/live_chat/get_live_chat_replay':
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('content-length', 0))
+        body = json.loads(self.rfile.read(length))
+        self.send_fixture(
+            'get_live_chat_replay', f'{quote(body["continuation"], safe="")}.json', 'application/json')
+
+    def send_fixture(self, kind, name, content_type):
+        path = self.fixtures_dir / kind / name
+        if not path.exists():
+            self.send_error(404)
+            return
+
+        if self.inject_fault():
+            return
+
+        content = path.read_bytes()
+        self.send_response(200)
+        self.send_header('content-type', f'{content_type}; charset=utf-8')
+        if 'gzip' in self.headers.get('accept-encoding', ''):
+            content = gzip.compress(content)
+            self.send_header('content-encoding', 'gzip')
+        self.send_header('content-length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        FixtureRequestHandler.sent_bytes += len(content)
+
+    def inject_fault(self):
+        # エラーの場合は、遅延(タイムアウト)またはステータスコードのみを返す
+        cls = FixtureRequestHandler
+        with cls.fault_lock:
+            cls.request_count += 1
+            fault = cls.fault_random.random() < cls.fault_rate
+            if not fault:
+                return False
+            cls.fault_count += 1
+            delay = cls.delay_seconds and cls.fault_random.random() < 0.5
+            status = cls.fault_random.choice(cls.fault_statuses)
+
+        if delay:
+            time.sleep(cls.delay_seconds)
+        self.send_response(status)
+        if cls.retry_after is not None:
+            self.send_header('retry-after', str(cls.retry_after))
+        self.send_header('content-length', '0')
+        self.end_headers()
+
+        return True
+
+    def log_message(self, format, *args):
+        print(f'{self.address_string()} {format % args}')
+
+
+def start_fixture_server(fixtures_dir='fixtures', port=0, fault_rate=0, delay_seconds=0):
+    # port=0の場合は空いているポートを使用する
+    FixtureRequestHandler.fixtures_dir = Path(fixtures_dir)
+    FixtureRequestHandler.fault_rate = fault_rate
+    FixtureRequestHandler.delay_seconds = delay_seconds
+    server = ThreadingHTTPServer(('127.0.0.1', port), FixtureRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    fixtures_dir = sys.argv[1] if len(sys.argv) >= 2 else 'fixtures'
+    port = int(sys.argv[2]) if len(sys.argv) >= 3 else 8080
+    fault_rate = float(sys.argv[3]) if len(sys.argv) >= 4 else 0
+    delay_seconds = float(sys.argv[4]) if len(sys.argv) >= 5 else 0
+
+    server, base_url = start_fixture_server(
+        fixtures_dir, port, fault_rate, delay_seconds)
+    print(f'serving {fixtures_dir} on {base_url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    print(f'total sent bytes: {FixtureRequestHandler.sent_bytes}')
+    print(
+        f'requests: {FixtureRequestHandler.request_count}, faults: {FixtureRequestHandler.fault_count}')
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+
+# 再試行するステータスコード(429は間隔を広げる対象にもなる)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_POOL_SIZE = 4
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 30
+
+
+class RetryExhaustedError(requests.exceptions.RequestException):
+    pass
+
+
+class AdaptiveRateLimiter(object):
+    # ホストごとにリクエスト間隔を空ける(スレッド間で共有)
+    # 成功するたびに加算的に速くし、429/5xxの場合は乗算的に遅くする(AIMD)
+    def __init__(self, requests_per_second, min_requests_per_second=None, increase=0.1, decrease=0.5):
+        self.max_rate = requests_per_second
+        self.min_rate = min_requests_per_second or requests_per_second / 16
+        self.increase = increase
+        self.decrease = decrease
+        self.lock = threading.Lock()
+        self.rates = {}
+        self.next_times = {}
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_times.get(host, now))
+            self.next_times[host] = request_time + \
+                1 / self.rates.get(host, self.max_rate)
+        if request_time > now:
+            time.sleep(request_time - now)
+
+    def on_success(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            rate = self.rates.get(host, self.max_rate)
+            self.rates[host] = min(self.max_rate, rate + self.increase)
+
+    def on_throttle(self, url, retry_after=None):
+        host = urlparse(url).netloc
+        with self.lock:
+            rate = self.rates.get(host, self.max_rate)
+            self.rates[host] = max(self.min_rate, rate * self.decrease)
+            # Retry-Afterが指定された場合は、その間は全スレッドで待つ
+            if retry_after:
+                self.next_times[host] = max(self.next_times.get(
+                    host, 0), time.monotonic() + retry_after)
+
+    def get_rate(self, url):
+        with self.lock:
+            return self.rates.get(urlparse(url).netloc, self.max_rate)
+
+
+class HttpTransport(object):
+    # タイムアウト、429/5xxの再試行、レート制限をまとめたリクエスト処理
+    # deadline(time.monotonic()の時刻)を指定した場合は、それまでに終わらない再試行はしない
+    def __init__(self, headers=None, rate_limiter=None, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES, pool_size=DEFAULT_POOL_SIZE):
+        self.session = create_session(pool_size)
+        if headers:
+            self.session.headers.update(headers)
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_count = 0
+        self.deadline = None
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.wait(url)
+
+            retry_after = None
+            attempt_start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = repr(e)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    if self.rate_limiter:
+                        self.rate_limiter.on_success(url)
+                    return response
+                error = f'status {response.status_code}'
+                retry_after = get_retry_after(response)
+                response.close()
+
+            if self.rate_limiter:
+                self.rate_limiter.on_throttle(url, retry_after)
+            if attempt >= self.max_retries:
+                break
+            delay = get_backoff_seconds(attempt, retry_after)
+            # 次の試行には、今回の試行と同じ時間がかかるものとする
+            attempt_seconds = time.monotonic() - attempt_start
+            if self.deadline is not None and time.monotonic() + delay + attempt_seconds > self.deadline:
+                raise RetryExhaustedError(
+                    f'{method} {url} failed, no time left to retry after {attempt + 1} attempts: {error}')
+            self.retry_count += 1
+            print(
+                f'retry {method} {urlparse(url).path} after {delay:.2f} sec ({error})')
+            time.sleep(delay)
+
+        raise RetryExhaustedError(
+            f'{method} {url} failed after {self.max_retries + 1} attempts: {error}')
+
+    def close(self):
+        self.session.close()
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE):
+    # 同じホストへの接続を使い回し、urllib3が展開できる圧縮形式(requirementsのbrotliによりbrも)を受け付ける
+    session = requests.session()
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['accept-encoding'] = ACCEPT_ENCODING
+
+    return session
+
+
+def get_backoff_seconds(attempt, retry_after=None):
+    # 指数バックオフ(フルジッター)、Retry-Afterの指定がある場合はそれ以上待つ
+    delay = random.uniform(
+        0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    if retry_after:
+        delay = max(delay, min(BACKOFF_MAX_SECONDS, retry_after))
+
+    return delay
+
+
+def get_retry_after(response):
+    # 秒数とHTTP日付の両方の形式に対応する
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
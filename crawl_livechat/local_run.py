@@ -2,15 +2,32 @@
 
 import os
 import yaml
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from google.oauth2.service_account import Credentials
+from google.api_core import exceptions
 from google.cloud import pubsub_v1
 from main import main
 
+ACK_DEADLINE_SECONDS = 60
+PULL_TIMEOUT_SECONDS = 10
+DEFAULT_MAX_ATTEMPTS = 5
+log_lock = threading.Lock()
+# 期限を延長する処理中のメッセージ(ack、nackの前に取り除く)
+ack_lock = threading.Lock()
+extending_ack_ids = set()
+# 配信回数(サブスクリプションにデッドレターの設定がない場合に、この実行内で数える)
+attempt_counts = {}
+
 
 def local_run():
     gcp_credentials_path = os.environ.get('GCP_CREDENTIALS_PATH')
     project_id = os.environ.get('PUBSUB_PROJECT_ID')
     topic_name = os.environ.get('PUBSUB_TOPIC_NAME')
+    concurrency = int(os.environ.get('LOCAL_RUN_CONCURRENCY', 1))
+    max_attempts = int(os.environ.get(
+        'LOCAL_RUN_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS))
 
     credentials = None
     if gcp_credentials_path and os.path.exists(gcp_credentials_path):
@@ -22,24 +39,97 @@ def local_run():
     subscription_path = subscriber.subscription_path(
         project_id, topic_name)
 
-    with subscriber:
+    in_flight = {}
+    with subscriber, ThreadPoolExecutor(max_workers=concurrency) as executor:
         while True:
-            print(f'listening for messages on {subscription_path}')
-            response = subscriber.pull(
-                request={'subscription': subscription_path, 'max_messages': 1})
-
-            for received_message in response.received_messages:
-                print(f'received: {received_message}')
-                subscriber.acknowledge(request={'subscription': subscription_path, 'ack_ids': [
-                                       received_message.ack_id]})
-                message = {
-                    'data': received_message.message.data
-                }
-                try:
-                    main(message, None)
-                except Exception as e:
-                    with open('local_run.log', 'a', encoding='utf-8') as f:
-                        f.write(f'error data: {message}\n')
+            if len(in_flight) < concurrency:
+                print(f'listening for messages on {subscription_path}')
+                received_messages = pull_messages(
+                    subscriber, subscription_path, concurrency - len(in_flight))
+                for received_message in received_messages:
+                    print(f'received: {received_message}')
+                    with ack_lock:
+                        extending_ack_ids.add(received_message.ack_id)
+                    future = executor.submit(
+                        run_message, subscriber, subscription_path, received_message, max_attempts)
+                    in_flight[future] = received_message.ack_id
+
+            if not in_flight:
+                continue
+
+            # 処理中のメッセージが再配信されないように期限を延長
+            # ack、nack済みのメッセージの期限を延長しないように、ロック中に送信する
+            with ack_lock:
+                if extending_ack_ids:
+                    subscriber.modify_ack_deadline(request={
+                        'subscription': subscription_path,
+                        'ack_ids': list(extending_ack_ids),
+                        'ack_deadline_seconds': ACK_DEADLINE_SECONDS})
+
+            done, _ = wait(in_flight, timeout=PULL_TIMEOUT_SECONDS,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                del in_flight[future]
+
+
+def pull_messages(subscriber, subscription_path, max_messages):
+    try:
+        response = subscriber.pull(
+            request={'subscription': subscription_path, 'max_messages': max_messages},
+            timeout=PULL_TIMEOUT_SECONDS)
+    except exceptions.DeadlineExceeded:
+        return []
+
+    return response.received_messages
+
+
+def run_message(subscriber, subscription_path, received_message, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    # Cloud Functionsと同じく、dataはbase64エンコードして渡す
+    message = {
+        'data': base64.b64encode(received_message.message.data)
+    }
+    message_id = received_message.message.message_id
+    error = None
+    try:
+        main(message, None)
+    except Exception as e:
+        error = e
+    # 処理が終わったメッセージは、ack、nackの前に期限の延長の対象から外す
+    with ack_lock:
+        extending_ack_ids.discard(received_message.ack_id)
+
+    if error:
+        attempt = get_delivery_attempt(received_message)
+        with log_lock, open('local_run.log', 'a', encoding='utf-8') as f:
+            f.write(
+                f'error data: {message}, attempt: {attempt}, {type(error).__name__}: {error}\n')
+        # アップロードまで完了しなかった場合は、上限の回数まで再配信させる
+        if attempt < max_attempts:
+            subscriber.modify_ack_deadline(request={
+                'subscription': subscription_path,
+                'ack_ids': [received_message.ack_id],
+                'ack_deadline_seconds': 0})
+            return
+
+        # 上限に達した場合は、ログに残して再配信させない
+        with log_lock, open('local_run.log', 'a', encoding='utf-8') as f:
+            f.write(f'dead letter data: {message}, attempt: {attempt}\n')
+
+    with ack_lock:
+        attempt_counts.pop(message_id, None)
+    subscriber.acknowledge(request={'subscription': subscription_path, 'ack_ids': [
+                           received_message.ack_id]})
+
+
+def get_delivery_attempt(received_message):
+    # デッドレターの設定があるサブスクリプションの場合のみ、delivery_attemptが設定される
+    if received_message.delivery_attempt:
+        return received_message.delivery_attempt
+
+    message_id = received_message.message.message_id
+    with ack_lock:
+        attempt_counts[message_id] = attempt_counts.get(message_id, 0) + 1
+        return attempt_counts[message_id]
 
 
 if __name__ == '__main__':
@@ -4,11 +4,24 @@ import os
 import sys
 import json
 import yaml
+import time
+import queue
 import base64
-from datetime import datetime, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from google.oauth2.service_account import Credentials
-from google.cloud import storage, pubsub_v1
+from requests.exceptions import RequestException
 from youtube_livechat_scraper import YoutubeLiveChatScraper, NoCommentsError, VideoAccessDeniedError
+from http_transport import HttpTransport, AdaptiveRateLimiter
+from comment_index import CommentIdIndex
+from crawl_checkpoint import CrawlCheckpoint, get_part_comments
+from crawl_budget import CrawlBudget, measure_transfer
+from gcp_io import get_bucket, get_json, upload_json, create_json, get_blob_list, publish_message, print_round_trips
+
+PIPELINE_QUEUE_SIZE = 4
+SEGMENT_MIN_SECONDS = 30 * 60
+rate_limiter_lock = threading.Lock()
 
 
 def main(event, context):
@@ -18,6 +31,15 @@ def main(event, context):
     duration_seconds = int(os.environ.get('CRAWL_DURATION_SECONDS'))
     project_id = os.environ.get('PUBSUB_PROJECT_ID')
     topic_name = os.environ.get('PUBSUB_TOPIC_NAME')
+    parquet_prefix = os.environ.get('GCS_PARQUET_PREFIX', '').rstrip('/')
+    ignore_videos_prefix = os.environ.get(
+        'GCS_IGNORE_VIDEOS_PREFIX', 'ignore_videos').rstrip('/')
+    default_transport = os.environ.get('CRAWL_TRANSPORT', 'html')
+    segment_count = int(os.environ.get('CRAWL_SEGMENT_COUNT', 1))
+    checkpoint_seconds = int(os.environ.get('CRAWL_CHECKPOINT_SECONDS', 60))
+    # 保存時間の推定に加えて残す時間
+    flush_reserve_seconds = int(
+        os.environ.get('CRAWL_FLUSH_RESERVE_SECONDS', 10))
 
     credentials = None
     if gcp_credentials_path and os.path.exists(gcp_credentials_path):
@@ -30,137 +52,358 @@ def main(event, context):
     channel_id = data['channel_id']
     video_id = data['video_id']
     continuation = data['continuation'] if 'continuation' in data else None
+    segments = data['segments'] if 'segments' in data else None
+    transport = data['transport'] if 'transport' in data else default_transport
+    # まとめる処理のみを次の実行に引き継いだ場合
+    compact = data['compact'] if 'compact' in data else False
 
     blob_path = f'{comments_prefix}/{channel_id}/{video_id}.json'
-
-    current_comments = get_json(
-        bucket_name, blob_path, credentials=credentials)
-    if not current_comments:
-        current_comments = []
-    print(f'curent comments count: {len(current_comments)}')
+    parts_prefix = f'{comments_prefix}/{channel_id}/{video_id}.parts'
+    index_path = f'{parts_prefix}/ids.gz'
+    # GCS_PARQUET_PREFIXを指定した場合は、まとめたコメントをJSONではなくParquetのみで保存する
+    parquet_path = f'{parquet_prefix}/{channel_id}/{video_id}.parquet' if parquet_prefix else None
 
     try:
-        print(f'get video comments of {video_id}')
-        new_comments, last_continuation = get_comments(
-            video_id, continuation, duration_seconds)
-
-        total_comments = current_comments
-        current_comment_ids = [x['id'] for x in current_comments]
-        for comment in new_comments:
-            if comment['id'] not in current_comment_ids:
-                total_comments.append(comment)
-        print(
-            f'add comments count: {len(total_comments) - len(current_comments)}')
-        print(f'upload video comments of {video_id}')
-        upload_json(bucket_name, blob_path, total_comments,
-                    credentials=credentials)
-
-        if last_continuation:
-            print(f'function timeout, next continuation: {last_continuation}')
+        # 前回の実行が途中で終了した場合も、最後のチェックポイントから再開する
+        checkpoint = CrawlCheckpoint(bucket_name, parts_prefix, index_path,
+                                     interval_seconds=checkpoint_seconds, credentials=credentials)
+        # 実行開始からの経過時間と、取得・解析・保存の推定時間から取得を終了する
+        budget = CrawlBudget(duration_seconds, margin_seconds=flush_reserve_seconds,
+                             get_save_bytes=checkpoint.get_flush_bytes)
+        state = checkpoint.load()
+        # まとめる処理のみの場合にチェックポイントがないときは、他の実行でまとめ済みのため取得しない
+        crawled = not checkpoint.is_complete() and not (compact and state is None)
+        if state is not None:
+            print(f'resume from checkpoint: {state}')
+            continuation = state.get('continuation')
+            segments = state.get('segments')
+        print(f'current comments count: {len(checkpoint.comment_index)}')
+
+        if crawled:
+            print(f'get video comments of {video_id}')
+            # 長時間の動画は再生位置で分割して並行に取得する
+            # 分割しない場合も、取得した最初のcontinuationから取得する
+            if not continuation and not segments and segment_count > 1:
+                segments, continuation = split_segments(
+                    video_id, segment_count, transport)
+
+            checkpoint.start(continuation, segments)
+            if segments:
+                get_segments_comments(
+                    video_id, segments, checkpoint, transport=transport, budget=budget)
+            else:
+                get_comments(video_id, continuation, transport=transport,
+                             checkpoint=checkpoint, budget=budget)
+            checkpoint.flush()
+            print(f'saved comments count: {len(checkpoint.comment_index)}')
+            budget.summary()
+
+        state = checkpoint.state or {}
+        if state.get('continuation'):
+            print(
+                f'function timeout, next continuation: {state["continuation"]}')
+            message = json.dumps({
+                'channel_id': channel_id,
+                'video_id': video_id,
+                'continuation': state['continuation'],
+                'transport': transport
+            }, ensure_ascii=False)
+            result = publish_message(
+                topic_name, project_id, message, credentials=credentials)
+            print(f'{video_id} Pub/Sub result: {result}')
+        elif state.get('segments'):
+            print(f'function timeout, remaining segments: {state["segments"]}')
             message = json.dumps({
                 'channel_id': channel_id,
                 'video_id': video_id,
-                'continuation': last_continuation
+                'segments': state['segments'],
+                'transport': transport
             }, ensure_ascii=False)
             result = publish_message(
                 topic_name, project_id, message, credentials=credentials)
             print(f'{video_id} Pub/Sub result: {result}')
+        else:
+            # パートの読み込みとまとめたファイルの保存が残り時間内に終わらない場合は、次の実行でまとめる
+            compact_bytes = get_compact_bytes(
+                bucket_name, parquet_path or blob_path, checkpoint.part_bytes, credentials=credentials)
+            if crawled and not budget.can_save(compact_bytes):
+                print(f'defer compaction of {video_id}, bytes: {compact_bytes}')
+                message = json.dumps({
+                    'channel_id': channel_id,
+                    'video_id': video_id,
+                    'transport': transport,
+                    'compact': True
+                }, ensure_ascii=False)
+                result = publish_message(
+                    topic_name, project_id, message, credentials=credentials)
+                print(f'{video_id} Pub/Sub result: {result}')
+                return
+
+            print(f'compact video comments of {video_id}')
+            measure_transfer('compact_timing', compact_bytes, compact_comments, bucket_name, blob_path, parts_prefix,
+                             parquet_path=parquet_path, credentials=credentials)
     except (NoCommentsError, VideoAccessDeniedError) as e:
         print(f'{type(e).__name__}: {str(e.args)}')
         # データ取得できなかった場合、Videoを検索無視登録
-        ignore_videos = get_json(
-            bucket_name, 'ignore_videos.json', credentials=credentials)
-        ignore_videos = ignore_videos if ignore_videos else []
-
-        if video_id not in [x['video_id'] for x in ignore_videos]:
+        # 動画ごとのファイルを、存在しない場合のみ作成する
+        data = {
+            'channel_id': channel_id,
+            'video_id': video_id,
+            'ignore_reason': f'{type(e).__name__}: {str(e.args)}'
+        }
+        ignore_path = f'{ignore_videos_prefix}/{channel_id}/{video_id}.json'
+        if create_json(bucket_name, ignore_path, data, credentials=credentials):
             print(f'add ignore videos list: {video_id}')
-            data = {
-                'channel_id': channel_id,
-                'video_id': video_id,
-                'ignore_reason': f'{type(e).__name__}: {str(e.args)}'
-            }
-            ignore_videos.append(data)
-            upload_json(bucket_name, 'ignore_videos.json',
-                        ignore_videos, credentials=credentials)
 
 
 # 時間切れの場合は、"continuation"も返す
-def get_comments(video_id, continuation=None, duration_secnods=-1):
+# checkpointを指定した場合は、取得したコメントをチェックポイントに記録して返さない
+# budgetを指定しない場合は、duration_secnodsの間取得する
+def get_comments(video_id, continuation=None, duration_secnods=-1, transport='html', start_offset_ms=None, end_offset_ms=None, checkpoint=None, stream_index=0, budget=None):
     video_comments = []
+    comments_count = 0
 
-    scraper = YoutubeLiveChatScraper()
+    scraper = create_scraper(transport)
 
     if not continuation:
         print(f'get initial continuation of {video_id}')
         continuation = scraper.get_initial_continuation(
             video_id=video_id)
+        if checkpoint:
+            checkpoint.set_continuation(stream_index, continuation)
     print(f'initial continuation: {continuation}')
 
-    has_next = True
-
-    end_time = datetime.now() + \
-        timedelta(seconds=duration_secnods) if duration_secnods > 0 else None
-    last_continuation = None
-    while has_next:
-        if end_time and datetime.now() >= end_time:
-            last_continuation = continuation
-            break
-
-        comments, continuation = scraper.get_livechat_from_continuation(
-            continuation=continuation)
-        video_comments.extend(comments)
-        has_next = continuation and len(comments) != 0
-        print(
-            f'get comments count: {len(comments)}, next_continuation: {continuation}')
-    print(f'total new comments count: {len(video_comments)}')
-
-    return video_comments, last_continuation
-
-
-def get_json(bucket_name, blob_path, credentials=None):
-    project_id = None
-    if credentials:
-        project_id = credentials.project_id
-    storage_client = storage.Client(
-        project=project_id, credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
-    # ファイルがない場合は、Noneを返す
-    data = None
-    blob = bucket.get_blob(blob_path)
-    if blob:
-        data = json.loads(blob.download_as_string())
-
-    return data
-
-
-def publish_message(topic_name, project_id, message, attributes={}, credentials=None):
-    publisher = pubsub_v1.PublisherClient(credentials=credentials)
-
-    topic_path = publisher.topic_path(project_id, topic_name)
-    future = publisher.publish(topic_path, str(
-        message).encode('utf-8'), **attributes)
-
-    return future.result()
-
-
-def upload_json(bucket_name, blob_path, data, credentials=None):
-    project_id = None
-    if credentials:
-        project_id = credentials.project_id
-    storage_client = storage.Client(
-        project=project_id, credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
-    upload_blob = bucket.blob(blob_path)
-    json_data = json.dumps(data, ensure_ascii=False, default=json_serial)
-    upload_blob.upload_from_string(
-        json_data, content_type='application/json')
+    if not budget:
+        budget = CrawlBudget(duration_secnods)
 
+    # ページ取得とコメント解析を別スレッドで並行して行う
+    pages = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop_event = threading.Event()
+    result = {'last_continuation': None}
+    fetcher = threading.Thread(target=fetch_pages, args=(
+        scraper, continuation, budget, pages, stop_event, result, start_offset_ms, end_offset_ms), daemon=True)
+    fetcher.start()
+
+    try:
+        while True:
+            page = pages.get()
+            if page is None:
+                break
+            if isinstance(page, Exception):
+                raise page
+
+            actions, next_continuation = page
+            parse_start = time.monotonic()
+            comments = scraper.parse_actions(actions)
+            budget.add_parse(time.monotonic() - parse_start)
+            comments_count += len(comments)
+            if checkpoint:
+                # アクションがない場合は、次のページを取得せずに終了する
+                checkpoint.add(stream_index, comments,
+                               next_continuation if actions else None)
+            else:
+                video_comments.extend(comments)
+            print(
+                f'get comments count: {len(comments)}, next_continuation: {next_continuation}')
+    finally:
+        stop_event.set()
+    fetcher.join()
+    print(f'total new comments count: {comments_count}')
+
+    return video_comments, result['last_continuation']
+
+
+def fetch_pages(scraper, continuation, budget, pages, stop_event, result, start_offset_ms=None, end_offset_ms=None):
+    # 次のcontinuationが取得でき次第、解析の完了を待たずに次ページを取得する
+    try:
+        while continuation and not stop_event.is_set():
+            # 次のページの取得・解析と保存が終わらない場合は、次の実行に引き継ぐ
+            if budget.should_stop():
+                result['last_continuation'] = continuation
+                break
+
+            try:
+                # 再試行は、取得後の解析と保存が実行時間内に終わる範囲でのみ行う
+                scraper.http.deadline = budget.get_fetch_deadline()
+                fetch_start = time.monotonic()
+                actions, next_continuation = scraper.get_livechat_actions(
+                    continuation, player_offset_ms=start_offset_ms)
+                budget.add_fetch(time.monotonic() - fetch_start)
+            except RequestException as e:
+                # 再試行しても取得できない場合は、時間切れと同様に続きから再開させる
+                print(f'failed to get continuation: {e}')
+                result['last_continuation'] = continuation
+                break
+            start_offset_ms = None
+            # 次のセグメントの範囲に到達した場合は終了
+            if end_offset_ms is not None:
+                segment_actions = [x for x in actions if not is_after_offset(
+                    scraper, x, end_offset_ms)]
+                if len(segment_actions) < len(actions):
+                    next_continuation = None
+                actions = segment_actions
+            put_page(pages, (actions, next_continuation), stop_event)
+            continuation = next_continuation if actions else None
+    except Exception as e:
+        put_page(pages, e, stop_event)
+    finally:
+        put_page(pages, None, stop_event)
+
+
+def is_after_offset(scraper, action, offset_ms):
+    action_offset_ms = scraper.get_action_offset_ms(action)
+
+    return action_offset_ms is not None and action_offset_ms >= offset_ms
+
+
+def create_scraper(transport='html'):
+    base_url = os.environ.get('YOUTUBE_BASE_URL', 'https://www.youtube.com')
+    # スーパーステッカーやメンバーシップも取得する場合は、レンダラー名をカンマ区切りで指定する
+    extra_renderers = [x.strip() for x in os.environ.get(
+        'CRAWL_EXTRA_RENDERERS', '').split(',') if x.strip()]
+    connect_timeout = float(os.environ.get('CRAWL_CONNECT_TIMEOUT', 5))
+    read_timeout = float(os.environ.get('CRAWL_READ_TIMEOUT', 30))
+    max_retries = int(os.environ.get('CRAWL_MAX_RETRIES', 4))
+    pool_size = int(os.environ.get('CRAWL_POOL_SIZE', 4))
+
+    http = HttpTransport(YoutubeLiveChatScraper.headers, rate_limiter=get_rate_limiter(),
+                         timeout=(connect_timeout, read_timeout), max_retries=max_retries, pool_size=pool_size)
+
+    return YoutubeLiveChatScraper(transport=transport, base_url=base_url, extra_renderers=extra_renderers, http=http)
+
+
+def get_rate_limiter():
+    # 同じプロセスで並行して取得する場合(セグメント、local_run)も、同じレート制限を使う
+    rate_limit = float(os.environ.get('CRAWL_RATE_LIMIT', 0))
+    if rate_limit <= 0:
+        return None
+
+    with rate_limiter_lock:
+        if not YoutubeLiveChatScraper.rate_limiter:
+            min_rate_limit = float(
+                os.environ.get('CRAWL_RATE_LIMIT_MIN', 0)) or None
+            YoutubeLiveChatScraper.rate_limiter = AdaptiveRateLimiter(
+                rate_limit, min_requests_per_second=min_rate_limit)
+
+    return YoutubeLiveChatScraper.rate_limiter
+
+
+# 分割できない場合は、セグメントをNoneとして最初のcontinuationのみを返す
+def split_segments(video_id, segment_count, transport='html'):
+    scraper = create_scraper(transport)
+
+    continuation, length_seconds = scraper.get_replay_info(video_id)
+    if not continuation or not length_seconds:
+        return None, continuation
+
+    segment_count = min(segment_count, length_seconds // SEGMENT_MIN_SECONDS)
+    if segment_count <= 1:
+        return None, continuation
+
+    segment_ms = length_seconds * 1000 // segment_count
+    segments = []
+    for i in range(segment_count):
+        segments.append({
+            'continuation': continuation,
+            'start_offset_ms': i * segment_ms,
+            'end_offset_ms': (i + 1) * segment_ms if i < segment_count - 1 else None
+        })
+    print(f'split {video_id} into {segment_count} segments')
+
+    return segments, continuation
+
+
+# 取得したコメントと時間切れになったセグメントは、チェックポイントに記録する
+def get_segments_comments(video_id, segments, checkpoint, duration_secnods=-1, transport='html', budget=None):
+    # 全セグメントで同じ実行時間の推定を使う
+    if not budget:
+        budget = CrawlBudget(duration_secnods)
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [executor.submit(
+            get_comments, video_id, x['continuation'], duration_secnods, transport,
+            start_offset_ms=x.get('start_offset_ms'), end_offset_ms=x.get('end_offset_ms'),
+            checkpoint=checkpoint, stream_index=i, budget=budget) for i, x in enumerate(segments)]
+
+    # セグメントで発生した例外を送出する
+    for future in futures:
+        future.result()
+
+
+def put_page(pages, page, stop_event):
+    # 解析側が停止している場合は、キューの空きを待たない
+    while not stop_event.is_set():
+        try:
+            pages.put(page, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+
+def get_compact_bytes(bucket_name, blob_path, part_bytes, credentials=None):
+    # まとめる処理で読み込み、書き込むサイズ(まとめ済みのファイルとパートの合計)
+    blob = get_bucket(bucket_name, credentials=credentials).get_blob(blob_path)
+    blob_bytes = blob.size if blob else 0
+
+    return (blob_bytes + part_bytes) * 2
 
-def json_serial(obj):
-    if isinstance(obj, datetime):
-        return obj.isoformat()
 
-    return obj
+def compact_comments(bucket_name, blob_path, parts_prefix, parquet_path=None, credentials=None):
+    # 取得完了後に、パートを1つのファイルにまとめる
+    blobs = sorted(get_blob_list(
+        bucket_name, parts_prefix, credentials=credentials), key=lambda x: x.name)
+    part_blobs = [x for x in blobs if x.name.endswith('.json')]
+    comments = get_compacted_comments(
+        bucket_name, blob_path, parquet_path=parquet_path, credentials=credentials)
+    # コメントが1件もない場合も、取得済みとして空のファイルを作る
+    if comments is not None and not part_blobs:
+        return
+
+    comments = comments if comments else []
+    comment_index = CommentIdIndex(x['id'] for x in comments)
+    for part_blob in part_blobs:
+        comments.extend(comment_index.filter_new(
+            get_part_comments(json.loads(part_blob.download_as_string()))))
+    # セグメントごとに並行して取得した場合は、パート内のコメントが取得順になっているため並べ替える
+    comments.sort(key=lambda x: x['timestamp'])
+    print(f'total comments count: {len(comments)}')
+
+    upload_comments(bucket_name, blob_path, comments,
+                    parquet_path=parquet_path, credentials=credentials)
+    for blob in blobs:
+        blob.delete()
+
+
+def get_compacted_comments(bucket_name, blob_path, parquet_path=None, credentials=None):
+    # まとめ済みのファイルがない場合は、Noneを返す
+    if not parquet_path:
+        return get_json(bucket_name, blob_path, credentials=credentials)
+
+    blob = get_bucket(bucket_name, credentials=credentials).get_blob(parquet_path)
+    if not blob:
+        return None
+
+    from comment_parquet import loads_parquet
+
+    return loads_parquet(blob.download_as_string())
+
+
+def upload_comments(bucket_name, blob_path, comments, parquet_path=None, credentials=None):
+    if not parquet_path:
+        upload_json(bucket_name, blob_path, comments, credentials=credentials)
+        return
+
+    # 列形式(Parquet)で保存する場合のみ、pyarrowを読み込む
+    # 動画ID、チャンネルIDは、JSONで保存する場合のパスから求める
+    from comment_parquet import dumps_parquet
+    input_path = Path(blob_path)
+    parquet_data = dumps_parquet(
+        comments, str(input_path.stem), str(input_path.parents[0].name))
+
+    bucket = get_bucket(bucket_name, credentials=credentials)
+    upload_blob = bucket.blob(parquet_path)
+    upload_blob.upload_from_string(
+        parquet_data, content_type='application/vnd.apache.parquet')
+    print(f'upload complete: {parquet_path}')
 
 
 if __name__ == '__main__':
@@ -173,12 +416,16 @@ if __name__ == '__main__':
     channel_id = sys.argv[1]
     video_id = sys.argv[2]
     continuation = sys.argv[3] if len(sys.argv) >= 4 else None
+    transport = sys.argv[4] if len(sys.argv) >= 5 else None
 
     data = {
         'channel_id': channel_id,
         'video_id': video_id,
         'continuation': continuation
     }
-    event = {'data': json.dumps(data, ensure_ascii=False)}
+    if transport:
+        data['transport'] = transport
+    event = {'data': base64.b64encode(json.dumps(data, ensure_ascii=False).encode('utf-8'))}
 
     main(event, None)
+    print_round_trips()
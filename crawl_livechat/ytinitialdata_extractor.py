@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import re
+import json
+import threading
+from contextlib import contextmanager
+
+
+# `var ytInitialData = {...}` と `window["ytInitialData"] = {...}` の両方に対応
+ASSIGNMENT_RE_FORMAT = r'(?:var\s+{name}|window\[\s*["\']{name}["\']\s*\])\s*=\s*'
+# 文字列リテラルと括弧のみを対象にして、それ以外の文字は読み飛ばす
+JSON_TOKEN_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]')
+# チャット欄に追加されるアイテムのみを対象にする(ティッカー内に埋め込まれたレンダラーは含まない)
+REPLAY_ACTION_RE = re.compile(r'"replayChatItemAction"\s*:\s*\{')
+ADD_CHAT_ITEM_RE = re.compile(r'"addChatItemAction"\s*:\s*\{')
+VIDEO_OFFSET_RE = re.compile(r'"videoOffsetTimeMsec"\s*:\s*"(\d+)"')
+LIVE_CHAT_CONTINUATION_RE = re.compile(r'"liveChatContinuation"\s*:\s*\{')
+MEMBER_RE = re.compile(r'\s*"(\w+)"\s*:\s*')
+MEMBER_SEPARATOR_RE = re.compile(r'\s*,')
+json_decoder = json.JSONDecoder()
+assignment_res = {}
+# GCを止めているスレッドの数(最後に終了したスレッドがGCを再開する)
+gc_pause_lock = threading.Lock()
+gc_pause_count = 0
+gc_was_enabled = False
+
+
+def get_assignment_re(name):
+    if name not in assignment_res:
+        assignment_res[name] = re.compile(
+            ASSIGNMENT_RE_FORMAT.format(name=re.escape(name)))
+
+    return assignment_res[name]
+
+
+def find_initial_data(text, name='ytInitialData'):
+    assignment_re = get_assignment_re(name)
+    m = assignment_re.search(text)
+    while m:
+        json_text = slice_json(text, m.end())
+        if json_text:
+            return json_text
+        m = assignment_re.search(text, m.end())
+
+    return None
+
+
+def find_initial_text(text, name='ytInitialData'):
+    # 代入以降のテキストを、JSONの終端を求めずに返す
+    m = get_assignment_re(name).search(text)
+    if not m:
+        return None
+
+    return text[m.end():]
+
+
+def extract_initial_data(text, name='ytInitialData'):
+    # 見つからない、またはJSONとして解釈できない場合は、Noneを返す
+    json_text = find_initial_data(text, name)
+    if not json_text:
+        return None
+
+    try:
+        return json.loads(json_text)
+    except ValueError:
+        return None
+
+
+def slice_json(text, start):
+    if start >= len(text) or text[start] not in '{[':
+        return None
+
+    depth = 0
+    for m in JSON_TOKEN_RE.finditer(text, start):
+        token = m.group()
+        if token == '{' or token == '[':
+            depth += 1
+        elif token == '}' or token == ']':
+            depth -= 1
+            if depth == 0:
+                return text[start:m.end()]
+
+    return None
+
+
+def skip_json_value(text, start):
+    # 値を読み込まずに、値の終端の位置を返す
+    if text[start] in '{[':
+        json_text = slice_json(text, start)
+        if not json_text:
+            raise ValueError(f'unterminated json value: {start}')
+        return start + len(json_text)
+
+    _, end = json_decoder.raw_decode(text, start)
+    return end
+
+
+def find_member(text, start, names):
+    # startのオブジェクト('{'の直後)の直下のキーから、namesに含まれるものを探す
+    # 見つかった場合は、キーと値の開始位置を返す
+    pos = start
+    while True:
+        m = MEMBER_RE.match(text, pos)
+        if not m:
+            return None, None
+        if m.group(1) in names:
+            return m.group(1), m.end()
+
+        m = MEMBER_SEPARATOR_RE.match(text, skip_json_value(text, m.end()))
+        if not m:
+            return None, None
+        pos = m.end()
+
+
+@contextmanager
+def gc_paused():
+    # JSONから作るオブジェクトは循環参照を持たないため、読み込み中はGCを止める
+    # 複数のスレッドで読み込む場合は、最後に終了したスレッドが元の状態に戻す
+    global gc_pause_count, gc_was_enabled
+    with gc_pause_lock:
+        if gc_pause_count == 0:
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+        gc_pause_count += 1
+    try:
+        yield
+    finally:
+        with gc_pause_lock:
+            gc_pause_count -= 1
+            if gc_pause_count == 0 and gc_was_enabled:
+                gc.enable()
+
+
+def extract_chat_actions(text, renderer_names):
+    # 全体をJSONとして読み込まず、指定したレンダラーのみを読み込む
+    # 返すアクションは、元のJSONと同じ構造で不要な要素を除いたもの
+    if '"continuations"' not in text:
+        return [], None
+
+    with gc_paused():
+        return scan_chat_actions(text, renderer_names)
+
+
+def scan_chat_actions(text, renderer_names):
+
+    continuation = find_replay_continuation(text)
+    starts = [x.start() for x in REPLAY_ACTION_RE.finditer(text)]
+    actions = []
+    for i, start in enumerate(starts):
+        end = starts[i + 1] if i + 1 < len(starts) else len(text)
+        chat_actions = []
+        for m in ADD_CHAT_ITEM_RE.finditer(text, start, end):
+            # レンダラーはitemの直下のキーのみを対象にする(キーの順序は問わない)
+            _, item_start = find_member(text, m.end(), ('item',))
+            if item_start is None or text[item_start] != '{':
+                continue
+            name, renderer_start = find_member(
+                text, item_start + 1, renderer_names)
+            if not name:
+                continue
+            renderer, _ = json_decoder.raw_decode(text, renderer_start)
+            chat_actions.append(
+                {'addChatItemAction': {'item': {name: renderer}}})
+
+        action = {'actions': chat_actions}
+        m = VIDEO_OFFSET_RE.search(text, start, end)
+        if m:
+            action['videoOffsetTimeMsec'] = m.group(1)
+        actions.append({'replayChatItemAction': action})
+
+    return actions, continuation
+
+
+def find_replay_continuation(text):
+    # liveChatContinuation直下のcontinuationsの配列のみを読み込み、リプレイの次のcontinuationを返す
+    m = LIVE_CHAT_CONTINUATION_RE.search(text)
+    if not m:
+        return None
+    _, continuations_start = find_member(text, m.end(), ('continuations',))
+    if continuations_start is None:
+        return None
+
+    continuations, _ = json_decoder.raw_decode(text, continuations_start)
+    for c in continuations:
+        if 'liveChatReplayContinuationData' in c:
+            return c['liveChatReplayContinuationData']['continuation']
+
+    return None
+
+
+def iter_script_bodies(chunks):
+    # レスポンスのバイト列から<script>の中身のみを順次返す
+    buffer = bytearray()
+    tag_start = -1
+    tag_end = -1
+    search_from = 0
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            if tag_start < 0:
+                tag_start = buffer.find(b'<script', search_from)
+                if tag_start < 0:
+                    # タグの途中で分割されている場合に備えて末尾を残す
+                    del buffer[:-len(b'<script')]
+                    search_from = 0
+                    break
+
+            if tag_end < 0:
+                tag_end = buffer.find(b'>', tag_start)
+                if tag_end < 0:
+                    break
+                search_from = tag_end + 1
+
+            body_end = buffer.find(b'</script', search_from)
+            if body_end < 0:
+                # 読み込み済みの部分は再検索しない
+                search_from = max(tag_end + 1, len(buffer) - len(b'</script'))
+                break
+
+            yield bytes(buffer[tag_end + 1:body_end])
+            del buffer[:body_end]
+            tag_start = -1
+            tag_end = -1
+            search_from = 0
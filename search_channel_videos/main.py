@@ -3,17 +3,37 @@
 import os
 import json
 import yaml
+import threading
 from datetime import datetime, timedelta
-from google.cloud import storage
+from concurrent.futures import ThreadPoolExecutor
+from gcp_io import get_bucket, get_json, upload_json, get_blob_names, print_round_trips
+from youtube_api_fake import FakeYoutube, RecordingYoutube
+from youtube_quota import QuotaExceededError, QuotaTokenBucket, QuotaLimitedYoutube, is_quota_exceeded
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from google.api_core import exceptions
 from google.oauth2.service_account import Credentials
 
+# videos.listで一度に指定できるIDの上限
+VIDEOS_LIST_MAX_IDS = 50
+DEFAULT_SEARCH_CONCURRENCY = 4
+
 
 def main(request):
     bucket_name = os.environ.get('GCS_BUCKET_NAME')
     api_key = os.environ.get('YOUTUBE_DATA_API_KEY')
     videos_prefix = os.environ.get('GCS_VIDEOS_PREFIX').rstrip('/')
+    state_prefix = os.environ.get(
+        'GCS_SEARCH_STATE_PREFIX', 'search_state').rstrip('/')
+    concurrency = int(os.environ.get(
+        'SEARCH_CONCURRENCY', DEFAULT_SEARCH_CONCURRENCY))
+    # クォータのトークンバケットの容量と、1秒あたりの補充量(どちらも0の場合は制限しない)
+    quota_budget = int(os.environ.get('YOUTUBE_QUOTA_BUDGET', 0))
+    quota_units_per_second = float(
+        os.environ.get('YOUTUBE_QUOTA_UNITS_PER_SECOND', 0))
+    discovery_mode = os.environ.get('DISCOVERY_MODE', 'search')
+    if discovery_mode not in ('search', 'playlist'):
+        raise ValueError(f'unknown discovery mode: {discovery_mode}')
     gcp_credentials_path = os.environ.get('GCP_CREDENTIALS_PATH')
     credentials = None
     if gcp_credentials_path and os.path.exists(gcp_credentials_path):
@@ -24,66 +44,162 @@ def main(request):
     channels = get_json(bucket_name, 'channels.json', credentials=credentials)
     print(f'channel count: {len(channels)}')
 
-    for channel in channels:
-        channel_name = channel['name']
-        channel_id = channel['channel_id']
-        blob_path = f'{videos_prefix}/{channel_id}.json'
-        channel_videos = get_json(
-            bucket_name, blob_path, credentials=credentials)
+    # 前回クォータ超過で中断したチャンネルから先に処理する
+    resume_channel_ids = set(get_resume_channel_ids(
+        bucket_name, state_prefix, credentials=credentials))
+    channels.sort(key=lambda x: x['channel_id'] not in resume_channel_ids)
+    print(f'resume channel count: {len(resume_channel_ids)}')
+
+    quota_bucket = QuotaTokenBucket(quota_budget, quota_units_per_second)
+    get_youtube = create_youtube_factory(api_key, quota_bucket)
+    # 記録はひとつのファイルに書き出すため、並列にしない
+    if os.environ.get('YOUTUBE_API_RECORD_PATH'):
+        concurrency = 1
+
+    def run_channel(channel):
+        # クォータ超過後は、未着手のチャンネルを次回に回す
+        if quota_bucket.stopped.is_set():
+            return 'skipped'
+        state = None
+        if channel['channel_id'] in resume_channel_ids:
+            state = get_json(bucket_name, f'{state_prefix}/{channel["channel_id"]}.json',
+                             credentials=credentials)
+        return update_channel_videos(
+            channel, get_youtube(), bucket_name, videos_prefix, state_prefix,
+            discovery_mode=discovery_mode, state=state, credentials=credentials)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(run_channel, channels))
+
+    result_counts = {x: results.count(x) for x in set(results)}
+    print(
+        f'channel results: {json.dumps(result_counts, sort_keys=True)}, quota used: {quota_bucket.used}')
+    if quota_bucket.stopped.is_set():
+        return 'search_channel_videos is stopped by API quota'
+
+    return 'search_channel_videos is completed'
+
+
+def update_channel_videos(channel, youtube, bucket_name, videos_prefix, state_prefix, discovery_mode='search', state=None, credentials=None):
+    channel_name = channel['name']
+    channel_id = channel['channel_id']
+    blob_path = f'{videos_prefix}/{channel_id}.json'
+    state_path = f'{state_prefix}/{channel_id}.json'
+    channel_videos = get_json(
+        bucket_name, blob_path, credentials=credentials)
 
-        print(f'start loading videos of "{channel_name}({channel_id})"')
+    print(f'start loading videos of "{channel_name}({channel_id})"')
 
-        # ファイルがない場合は、すべて取得
+    # ファイルがない場合は、すべて取得
+    latest_published_at = None
+    if channel_videos:
+        latest_video = max(channel_videos, key=lambda x: x['published_at'])
+        latest_published_at = datetime.strptime(
+            latest_video['published_at'], '%Y-%m-%dT%H:%M:%SZ')
+    else:
+        channel_videos = []
+    print(f'current video count: {len(channel_videos)}')
+
+    # ページトークンは同じ検索条件でのみ有効なため、中断時の条件で再開する
+    partial_videos = []
+    page_token = None
+    has_state = state is not None
+    if state and state.get('discovery_mode', 'search') != discovery_mode:
+        print(
+            f'discard resume state of "{channel_name}({channel_id})" for {state.get("discovery_mode", "search")} mode')
+        state = None
+    if state:
         latest_published_at = None
-        if channel_videos:
-            latest_video = max(channel_videos, key=lambda x: x['published_at'])
+        if state['published_after']:
             latest_published_at = datetime.strptime(
-                latest_video['published_at'], '%Y-%m-%dT%H:%M:%SZ')
-        else:
-            channel_videos = []
-        print(f'current video count: {len(channel_videos)}')
+                state['published_after'], '%Y-%m-%dT%H:%M:%SZ')
+        partial_videos = state['videos']
+        page_token = state['page_token']
         print(
-            f'get channel videos of "{channel_name}({channel_id})" after {latest_published_at}')
-        new_videos = get_videos(channel_id, api_key, after=latest_published_at)
-        print(f'new video count: {len(new_videos)}')
-
-        channel_videos.extend(new_videos)
-        channel_videos = unique_list(channel_videos)
-        channel_videos.sort(key=lambda x: x['published_at'])
-        print(f'total video count: {len(channel_videos)}')
-        if len(new_videos) > 0:
-            upload_videos(bucket_name, blob_path, channel_videos,
-                          credentials=credentials)
-            print(
-                f'complete uploading videos of "{channel_name}({channel_id})"')
+            f'resume "{channel_name}({channel_id})" with {len(partial_videos)} videos')
 
-    return 'search_channel_videos is completed'
+    print(
+        f'get channel videos of "{channel_name}({channel_id})" after {latest_published_at}')
+    get_channel_videos = get_playlist_videos if discovery_mode == 'playlist' else get_videos
+    try:
+        new_videos = get_channel_videos(channel_id, None, after=latest_published_at,
+                                        youtube=youtube, page_token=page_token)
+    except QuotaExceededError as e:
+        # 途中までの動画は最新日時の判定を狂わせるため、動画一覧ではなく再開用の状態に保存する
+        state = {
+            'discovery_mode': discovery_mode,
+            'published_after': datetime.strftime(latest_published_at, '%Y-%m-%dT%H:%M:%SZ') if latest_published_at else None,
+            'page_token': e.page_token,
+            'videos': partial_videos + e.videos,
+        }
+        upload_json(bucket_name, state_path, state, credentials=credentials)
+        print(
+            f'stop loading videos of "{channel_name}({channel_id})" by API quota: {len(state["videos"])} videos')
+        return 'stopped'
+    new_videos = partial_videos + new_videos
+    print(f'new video count: {len(new_videos)}')
+
+    channel_videos.extend(new_videos)
+    channel_videos = unique_list(channel_videos)
+    channel_videos.sort(key=lambda x: x['published_at'])
+    print(f'total video count: {len(channel_videos)}')
+    if len(new_videos) > 0:
+        upload_videos(bucket_name, blob_path, channel_videos,
+                      credentials=credentials)
+        print(
+            f'complete uploading videos of "{channel_name}({channel_id})"')
+    if has_state:
+        delete_search_state(bucket_name, state_path, credentials=credentials)
 
+    return 'completed'
 
-def get_json(bucket_name, blob_path, credentials=None):
-    project_id = None
-    if credentials:
-        project_id = credentials.project_id
-    storage_client = storage.Client(
-        project=project_id, credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
-    # ファイルがない場合は、Noneを返す
-    data = None
-    blob = bucket.get_blob(blob_path)
-    if blob:
-        data = json.loads(blob.download_as_string())
 
-    return data
+def get_resume_channel_ids(bucket_name, state_prefix, credentials=None):
+    blob_names = get_blob_names(
+        bucket_name, state_prefix, credentials=credentials)
+    return [x[len(state_prefix) + 1:-len('.json')] for x in blob_names if x.endswith('.json')]
 
 
-def get_videos(channel_id, api_key, after=None):
-    youtube = build('youtube', 'v3', developerKey=api_key)
+def delete_search_state(bucket_name, state_path, credentials=None):
+    bucket = get_bucket(bucket_name, credentials=credentials)
+    try:
+        bucket.blob(state_path).delete()
+    except exceptions.NotFound:
+        pass
+
+
+def create_youtube_factory(api_key, quota_bucket):
+    # YOUTUBE_API_REPLAY_PATHを指定した場合は、記録済みのレスポンスを使用する
+    replay_path = os.environ.get('YOUTUBE_API_REPLAY_PATH')
+    if replay_path:
+        youtube = QuotaLimitedYoutube(
+            FakeYoutube.load(replay_path), quota_bucket)
+        return lambda: youtube
+
+    # APIクライアントはスレッドセーフではないため、スレッドごとに作成する
+    record_path = os.environ.get('YOUTUBE_API_RECORD_PATH')
+    thread_local = threading.local()
+
+    def get_youtube():
+        if not hasattr(thread_local, 'youtube'):
+            youtube = build('youtube', 'v3', developerKey=api_key)
+            if record_path:
+                youtube = RecordingYoutube(youtube, record_path)
+            thread_local.youtube = QuotaLimitedYoutube(youtube, quota_bucket)
+        return thread_local.youtube
+
+    return get_youtube
+
+
+def get_videos(channel_id, api_key, after=None, youtube=None, page_token=None):
+    if youtube is None:
+        youtube = build('youtube', 'v3', developerKey=api_key)
     after_str = None
     # 保管されている最新動画以降のデータを取得
     if after:
         after_str = datetime.strftime(
             after + timedelta(seconds=1), '%Y-%m-%dT%H:%M:%SZ')
-    next_page_token = None
+    next_page_token = page_token
     has_next = True
     videos = []
     try:
@@ -99,6 +215,7 @@ def get_videos(channel_id, api_key, after=None):
                 pageToken=next_page_token
             ).execute()
 
+            page_videos = []
             for search_item in search_result.get('items', []):
                 kind = search_item['id']['kind']
                 if kind != 'youtube#video':
@@ -110,15 +227,17 @@ def get_videos(channel_id, api_key, after=None):
                 video_item['channelTitle'] = search_item['snippet']['channelTitle']
                 video_item['title'] = search_item['snippet']['title']
                 video_item['published_at'] = search_item['snippet']['publishedAt']
+                page_videos.append(video_item)
 
-                video_details_result = youtube.videos().list(
-                    part='contentDetails',
-                    id=video_item['video_id']
-                ).execute()
-
-                video_details_item = video_details_result.get('items', [])[0]
+            # ページ内の動画の詳細をまとめて取得する
+            video_details = get_video_details(
+                youtube, [x['video_id'] for x in page_videos], 'contentDetails')
+            for video_item in page_videos:
+                if video_item['video_id'] not in video_details:
+                    print(f'video details not found: {video_item["video_id"]}')
+                    continue
+                video_details_item = video_details[video_item['video_id']]
                 video_item['duration'] = video_details_item['contentDetails']['duration']
-
                 videos.append(video_item)
 
             if 'nextPageToken' in search_result.keys():
@@ -127,23 +246,116 @@ def get_videos(channel_id, api_key, after=None):
             else:
                 next_page_token = None
                 has_next = False
+    except QuotaExceededError as e:
+        # 取得済みのページと、再開するページのトークンを渡す
+        raise QuotaExceededError(videos, next_page_token) from e
+    except HttpError as e:
+        if e.resp.status == 403:
+            print('Youtube API Error')
+            if is_quota_exceeded(e):
+                print('API access quota exceeded')
+                raise QuotaExceededError(videos, next_page_token) from e
+            raise
+
+    return videos
+
+
+def get_playlist_videos(channel_id, api_key, after=None, youtube=None, page_token=None):
+    # アップロード動画の再生リストを新しい順にたどり、配信済みのライブのみを取得する
+    # search.list(100ユニット)ではなく、playlistItems.list(1ユニット)を使う
+    if youtube is None:
+        youtube = build('youtube', 'v3', developerKey=api_key)
+    playlist_id = get_uploads_playlist_id(channel_id)
+    next_page_token = page_token
+    has_next = True
+    videos = []
+    try:
+        while has_next:
+            print(f'loading count: {len(videos)}')
+            playlist_result = youtube.playlistItems().list(
+                part='contentDetails',
+                playlistId=playlist_id,
+                maxResults=50,
+                pageToken=next_page_token
+            ).execute()
+
+            # 保管されている最新動画より前の動画に達したら、以降のページは取得しない
+            video_ids = []
+            reached_after = False
+            for playlist_item in playlist_result.get('items', []):
+                content_details = playlist_item['contentDetails']
+                # 非公開・削除済みの動画には公開日時がない
+                if 'videoPublishedAt' not in content_details:
+                    continue
+                published_at = datetime.strptime(
+                    content_details['videoPublishedAt'], '%Y-%m-%dT%H:%M:%SZ')
+                if after and published_at <= after:
+                    reached_after = True
+                    continue
+                video_ids.append(content_details['videoId'])
+
+            video_details = get_video_details(
+                youtube, video_ids, 'liveStreamingDetails,contentDetails,snippet')
+            for video_id in video_ids:
+                video_details_item = video_details.get(video_id)
+                if not video_details_item or not is_completed_live(video_details_item):
+                    continue
+
+                video_item = {}
+                video_item['video_id'] = video_id
+                video_item['channel_id'] = video_details_item['snippet']['channelId']
+                video_item['channelTitle'] = video_details_item['snippet']['channelTitle']
+                video_item['title'] = video_details_item['snippet']['title']
+                video_item['published_at'] = video_details_item['snippet']['publishedAt']
+                video_item['duration'] = video_details_item['contentDetails']['duration']
+                videos.append(video_item)
+
+            if 'nextPageToken' in playlist_result.keys() and not reached_after:
+                next_page_token = playlist_result['nextPageToken']
+                has_next = True
+            else:
+                next_page_token = None
+                has_next = False
+    except QuotaExceededError as e:
+        raise QuotaExceededError(videos, next_page_token) from e
     except HttpError as e:
         if e.resp.status == 403:
             print('Youtube API Error')
-            if json.loads(e.content)['error']['errors'][0]['reason'] == 'quotaExceeded':
+            if is_quota_exceeded(e):
                 print('API access quota exceeded')
+                raise QuotaExceededError(videos, next_page_token) from e
             raise
 
     return videos
 
 
+def get_uploads_playlist_id(channel_id):
+    # チャンネルIDのUCをUUに置き換えると、アップロード動画の再生リストになる
+    return f'UU{channel_id[2:]}'
+
+
+def is_completed_live(video_details_item):
+    live_streaming_details = video_details_item.get('liveStreamingDetails', {})
+    return video_details_item['snippet'].get('liveBroadcastContent') == 'none' and \
+        'actualEndTime' in live_streaming_details
+
+
+def get_video_details(youtube, video_ids, part):
+    video_details = {}
+    for i in range(0, len(video_ids), VIDEOS_LIST_MAX_IDS):
+        video_details_result = youtube.videos().list(
+            part=part,
+            id=','.join(video_ids[i:i + VIDEOS_LIST_MAX_IDS])
+        ).execute()
+
+        for video_details_item in video_details_result.get('items', []):
+            video_details[video_details_item['id']] = video_details_item
+
+    return video_details
+
+
 def upload_videos(bucket_name, blob_path, videos, credentials=None):
-    project_id = None
-    if credentials:
-        project_id = credentials.project_id
-    storage_client = storage.Client(
-        project=project_id, credentials=credentials)
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = get_bucket(bucket_name, credentials=credentials)
     upload_blob = bucket.blob(blob_path)
     videos_json = json.dumps(videos, ensure_ascii=False)
     upload_blob.upload_from_string(
@@ -162,3 +374,4 @@ if __name__ == '__main__':
                 os.environ[k] = str(v)
 
     main(None)
+    print_round_trips()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import httplib2
+from pathlib import Path
+from googleapiclient.errors import HttpError
+from youtube_quota import QUOTA_COSTS
+
+# YouTube Data APIのレスポンスを記録・再生する
+# 記録ファイルの形式:
+#   {"search": {"<channelId>:<pageToken>": response},
+#    "videos": {"<videoId>": item},
+#    "playlistItems": {"<playlistId>:<pageToken>": response}}
+
+
+def get_page_key(kind, params):
+    owner = params.get('channelId') if kind == 'search' else params.get('playlistId')
+    return f'{owner}:{params.get("pageToken") or ""}'
+
+
+class FakeYoutube(object):
+    # quota_limitを超えるリクエストは、APIと同じquotaExceededのエラーにする
+    def __init__(self, responses, quota_limit=0):
+        self.responses = responses
+        self.quota_limit = quota_limit
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.quota_used = 0
+
+    @classmethod
+    def load(cls, path, quota_limit=0):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f), quota_limit=quota_limit)
+
+    def search(self):
+        return FakeResource(self, 'search')
+
+    def videos(self):
+        return FakeResource(self, 'videos')
+
+    def playlistItems(self):
+        return FakeResource(self, 'playlistItems')
+
+    def execute(self, kind, params):
+        with self.lock:
+            self.request_count += 1
+            if self.quota_limit > 0 and self.quota_used + QUOTA_COSTS[kind] > self.quota_limit:
+                raise quota_exceeded_error()
+            self.quota_used += QUOTA_COSTS[kind]
+
+        responses = self.responses.get(kind, {})
+        if kind == 'videos':
+            video_ids = params['id'].split(',')
+            return {'items': [responses[x] for x in video_ids if x in responses]}
+
+        return responses.get(get_page_key(kind, params), {'items': []})
+
+
+def quota_exceeded_error():
+    content = json.dumps({'error': {'code': 403, 'errors': [
+        {'reason': 'quotaExceeded', 'domain': 'youtube.quota'}]}})
+    return HttpError(httplib2.Response({'status': 403}), content.encode('utf-8'))
+
+
+class FakeResource(object):
+    def __init__(self, youtube, kind):
+        self.youtube = youtube
+        self.kind = kind
+
+    def list(self, **params):
+        return FakeRequest(self.youtube, self.kind, params)
+
+
+class FakeRequest(object):
+    def __init__(self, youtube, kind, params):
+        self.youtube = youtube
+        self.kind = kind
+        self.params = params
+
+    def execute(self):
+        return self.youtube.execute(self.kind, self.params)
+
+
+class RecordingYoutube(object):
+    # 実際のAPIのレスポンスを、FakeYoutubeで再生できる形式で保存する
+    def __init__(self, youtube, path):
+        self.youtube = youtube
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.responses = {'search': {}, 'videos': {}, 'playlistItems': {}}
+        if self.path.exists():
+            self.responses.update(json.loads(self.path.read_text(encoding='utf-8')))
+
+    def search(self):
+        return RecordingResource(self, 'search', self.youtube.search())
+
+    def videos(self):
+        return RecordingResource(self, 'videos', self.youtube.videos())
+
+    def playlistItems(self):
+        return RecordingResource(self, 'playlistItems', self.youtube.playlistItems())
+
+    def record(self, kind, params, response):
+        with self.lock:
+            if kind == 'videos':
+                for item in response.get('items', []):
+                    self.responses[kind][item['id']] = item
+            else:
+                self.responses[kind][get_page_key(kind, params)] = response
+            self.path.write_text(json.dumps(
+                self.responses, ensure_ascii=False), encoding='utf-8')
+
+
+class RecordingResource(object):
+    def __init__(self, recorder, kind, resource):
+        self.recorder = recorder
+        self.kind = kind
+        self.resource = resource
+
+    def list(self, **params):
+        return RecordingRequest(self.recorder, self.kind, params, self.resource.list(**params))
+
+
+class RecordingRequest(object):
+    def __init__(self, recorder, kind, params, request):
+        self.recorder = recorder
+        self.kind = kind
+        self.params = params
+        self.request = request
+
+    def execute(self):
+        response = self.request.execute()
+        self.recorder.record(self.kind, self.params, response)
+
+        return response
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+from googleapiclient.errors import HttpError
+
+# APIごとのクォータ消費量
+QUOTA_COSTS = {
+    'search': 100,
+    'videos': 1,
+    'playlistItems': 1,
+}
+QUOTA_EXCEEDED_REASONS = ('quotaExceeded', 'dailyLimitExceeded')
+
+
+class QuotaExceededError(Exception):
+    # 途中まで取得した動画と、再開用のページトークンを保持する
+    def __init__(self, videos=None, page_token=None):
+        super().__init__('API access quota exceeded')
+        self.videos = videos or []
+        self.page_token = page_token
+
+
+def is_quota_exceeded(e):
+    if e.resp.status != 403:
+        return False
+    try:
+        reason = json.loads(e.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError):
+        return False
+
+    return reason in QUOTA_EXCEEDED_REASONS
+
+
+class QuotaTokenBucket(object):
+    # クォータを全スレッドで共有するトークンバケット
+    # budgetはバケットの容量(1回の実行の上限ではない)で、補充する場合はusedがbudgetを超える
+    # budgetが0の場合は制限なし、units_per_secondが0の場合は補充せず、budgetが実行ごとの上限になる
+    def __init__(self, budget=0, units_per_second=0):
+        self.budget = budget
+        self.units_per_second = units_per_second
+        self.tokens = budget
+        self.used = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.updated_at = time.monotonic()
+
+    def acquire(self, units):
+        while True:
+            if self.stopped.is_set():
+                raise QuotaExceededError()
+            with self.lock:
+                if self.budget <= 0:
+                    self.used += units
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.budget, self.tokens +
+                                  (now - self.updated_at) * self.units_per_second)
+                self.updated_at = now
+                # 容量より大きいリクエストは、補充を待っても実行できない
+                if units > self.budget:
+                    self.stopped.set()
+                    raise QuotaExceededError()
+                if self.tokens >= units:
+                    self.tokens -= units
+                    self.used += units
+                    return
+                if self.units_per_second <= 0:
+                    self.stopped.set()
+                    raise QuotaExceededError()
+                wait_seconds = (units - self.tokens) / self.units_per_second
+            time.sleep(wait_seconds)
+
+    def stop(self):
+        # 以降のリクエストをすべて止める
+        self.stopped.set()
+
+
+class QuotaLimitedYoutube(object):
+    def __init__(self, youtube, bucket):
+        self.youtube = youtube
+        self.bucket = bucket
+
+    def search(self):
+        return QuotaLimitedResource(self.bucket, 'search', self.youtube.search())
+
+    def videos(self):
+        return QuotaLimitedResource(self.bucket, 'videos', self.youtube.videos())
+
+    def playlistItems(self):
+        return QuotaLimitedResource(self.bucket, 'playlistItems', self.youtube.playlistItems())
+
+
+class QuotaLimitedResource(object):
+    def __init__(self, bucket, kind, resource):
+        self.bucket = bucket
+        self.kind = kind
+        self.resource = resource
+
+    def list(self, **params):
+        return QuotaLimitedRequest(self.bucket, self.kind, self.resource.list(**params))
+
+
+class QuotaLimitedRequest(object):
+    def __init__(self, bucket, kind, request):
+        self.bucket = bucket
+        self.kind = kind
+        self.request = request
+
+    def execute(self):
+        self.bucket.acquire(QUOTA_COSTS[self.kind])
+        try:
+            return self.request.execute()
+        except HttpError as e:
+            if is_quota_exceeded(e):
+                self.bucket.stop()
+                raise QuotaExceededError() from e
+            raise